@@ -1,9 +1,98 @@
 '''
     AppConfig for django-cleanup, prepare the cache and connect signal handlers
 '''
+import logging
+import time
+
 from django.apps import AppConfig
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import DO_NOTHING
+from django.db.models.deletion import get_candidate_relations_to_delete
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+
+from . import cache, conf, handlers
+from .query import CleanupQuerySetMixin
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_fast_delete_blocker(model):
+    '''
+        The reason the ORM cannot fast delete the rows of a model, apart from the receivers of
+        django-cleanup, see `Collector.can_fast_delete`, or None
+    '''
+    opts = model._meta
+    if opts.concrete_model._meta.parents:
+        return 'it has parent models'
+    for related in get_candidate_relations_to_delete(opts):
+        if related.field.remote_field.on_delete is not DO_NOTHING:
+            return (
+                f'{cache.get_model_name(related.related_model)}.{related.field.name} '
+                'does not use on_delete=DO_NOTHING')
+    for field in opts.private_fields:
+        if hasattr(field, 'bulk_related_objects'):
+            return f'it has the generic relation {field.name}'
+    for signal in (pre_delete, post_delete, m2m_changed):
+        if signal.has_listeners(model):
+            return 'it has pre_delete, post_delete or m2m_changed receivers'
+    return None
+
 
-from . import cache, handlers
+def check_fast_delete():
+    '''
+        Models marked with `cleanup.fast_delete` read the file names of fast deleted rows in their
+        base manager's queryset. They get no post_delete handler, so the ORM must be able to fast
+        delete them, rows that are loaded and deleted would keep their files.
+    '''
+    if not cache.STATE['fast_delete']:
+        return
+    for model in cache.cleanup_models():
+        if not cache.is_fast_delete(model):
+            continue
+        model_name = cache.get_model_name(model)
+        if not isinstance(model._base_manager.get_queryset(), CleanupQuerySetMixin):
+            raise ImproperlyConfigured(
+                f'The base manager of {model_name} must use a CleanupQuerySet for fast delete, '
+                "set Meta.base_manager_name to a manager made with CleanupQuerySet")
+        blocker = get_fast_delete_blocker(model)
+        if blocker is not None:
+            raise ImproperlyConfigured(
+                f'{model_name} is marked with cleanup.fast_delete but the ORM cannot fast delete '
+                f'it, {blocker}')
+
+
+def prepare_and_connect(select_mode):
+    '''
+        Prepare the cache and connect the handlers, every model at startup or, with the
+        CLEANUP_LAZY setting, each model on its first signal. The timing is kept in `cache.STARTUP`.
+    '''
+    lazy = conf.get('LAZY')
+    dispatch = conf.get('DISPATCH')
+    if dispatch not in ('model', 'single'):
+        raise ImproperlyConfigured(
+            f"CLEANUP_DISPATCH must be one of model, single, not {dispatch!r}")
+    dispatch = 'single' if lazy else dispatch
+
+    start = time.perf_counter()
+    if lazy:
+        cache.prepare_lazy(select_mode)
+    else:
+        cache.prepare(select_mode)
+    check_fast_delete()
+    prepared = time.perf_counter()
+    if dispatch == 'single':
+        handlers.connect_dispatchers()
+    else:
+        handlers.connect()
+    connected = time.perf_counter()
+    cache.STARTUP.update(
+        mode='lazy' if lazy else 'eager', dispatch=dispatch, prepare_seconds=prepared - start,
+        connect_seconds=connected - prepared)
+    logger.debug(
+        'Prepared django-cleanup in %s mode in %.2fms, connected the %s dispatch handlers in '
+        '%.2fms', cache.STARTUP['mode'], cache.STARTUP['prepare_seconds'] * 1e3, dispatch,
+        cache.STARTUP['connect_seconds'] * 1e3)
 
 
 class CleanupConfig(AppConfig):
@@ -12,13 +101,11 @@ class CleanupConfig(AppConfig):
     default = True
 
     def ready(self):
-        cache.prepare(False)
-        handlers.connect()
+        prepare_and_connect(False)
 
 class CleanupSelectedConfig(AppConfig):
     name = 'django_cleanup'
     verbose_name = 'Django Cleanup'
 
     def ready(self):
-        cache.prepare(True)
-        handlers.connect()
+        prepare_and_connect(True)
@@ -1,13 +1,22 @@
 ''' Our local cache of filefields, everything is private to this package.'''
-from collections import defaultdict
+import threading
+import time
+import weakref
+from collections import defaultdict, namedtuple
+from contextvars import ContextVar
 
 from django.apps import apps
-from django.db import models
+from django.db import connections, models, router
 from django.utils.module_loading import import_string
 
+from . import conf, metrics
+
 
 CACHE_NAME = '_django_cleanup_original_cache'
 
+# when set instances are loaded without a cache, see `cleanup.readonly`
+READONLY = ContextVar('django_cleanup_readonly', default=False)
+
 
 def fields_default():
     return set()
@@ -18,6 +27,70 @@ def fields_dict_default():
     return {}
 FIELDS_FIELDS = defaultdict(fields_dict_default)
 FIELDS_STORAGE = defaultdict(fields_dict_default)
+# weak references to the field and storage instances, model name -> field name -> (field, storage)
+FIELDS_INSTANCES = defaultdict(fields_dict_default)
+
+
+# the compiled plan of file fields for each model class, see `make_model_plan`
+ModelPlan = namedtuple('ModelPlan', ['model_name', 'fields', 'fields_by_name', 'names'])
+FieldPlan = namedtuple('FieldPlan', ['name', 'attname', 'field', 'storage', 'default'])
+PLANS = {}
+EMPTY_PLAN = ModelPlan('', (), {}, ())
+
+
+class Snapshot:
+    '''
+        The cleanup cache of an instance, the original file names of its loaded file fields. A
+        read only mapping of field name to file name that pickles to the two tuples.
+    '''
+    __slots__ = ('fields', 'names')
+
+    def __init__(self, fields, names):
+        self.fields = fields
+        self.names = names
+
+    def __reduce__(self):
+        return Snapshot, (self.fields, self.names)
+
+    def __getitem__(self, field_name):
+        try:
+            return self.names[self.fields.index(field_name)]
+        except ValueError:
+            raise KeyError(field_name) from None
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return f'Snapshot({dict(self.items())!r})'
+
+    def get(self, field_name, default=None):
+        try:
+            return self.names[self.fields.index(field_name)]
+        except ValueError:
+            return default
+
+    def items(self):
+        return zip(self.fields, self.names)
+
+# the select mode of the cache, and in lazy mode if every model has been prepared and the number
+# and time of the models prepared on first use, see `prepare_lazy`. Models marked with
+# `cleanup.fast_delete` are only fast deleted when all models are prepared at startup.
+STATE = {
+    'select_mode': False, 'complete': True, 'fast_delete': True, 'lazy_models': 0,
+    'lazy_seconds': 0}
+LOCK = threading.Lock()
+# the timing of the app startup, see `apps.prepare_and_connect`
+STARTUP = {}
+
+# the names of callable defaults, (model class, field name) -> name, see `get_default_name`
+DEFAULT_NAMES = {}
+# the models marked with `cleanup.fast_delete` that a delete receiver connected after the startup
+# stops the ORM from fast deleting, see `handlers.keep_fast_delete`
+FAST_DELETE_BLOCKED = set()
 
 
 # cache init ##
@@ -28,16 +101,89 @@ def prepare(select_mode):
     if FIELDS:  # pragma: no cover
         return
 
+    PLANS.clear()
+    DEFAULT_NAMES.clear()
+    FAST_DELETE_BLOCKED.clear()
+    STATE.update(select_mode=select_mode, complete=True, fast_delete=True)
+    for model in apps.get_models():
+        prepare_model(model, select_mode)
+
+
+def prepare_model(model, select_mode):
+    '''Prepare the cache for one model'''
+    if ignore_model(model, select_mode):
+        return
+    name = get_model_name(model)
+    if model_has_filefields(name):  # pragma: no cover
+        return
+    opts = model._meta
+    for field in opts.get_fields():
+        if isinstance(field, models.FileField):
+            add_field_for_model(name, field.name, field)
+    if model_has_filefields(name):
+        PLANS[model] = make_model_plan(model, name)
+
+
+def prepare_lazy(select_mode):
+    '''
+        Prepare the cache of each model the first time one of its signals is sent, instead of
+        walking every model at startup, see `get_lazy_plan`.
+    '''
+    PLANS.clear()
+    DEFAULT_NAMES.clear()
+    STATE.update(
+        select_mode=select_mode, complete=False, fast_delete=False, lazy_models=0, lazy_seconds=0)
+
+
+def get_lazy_plan(model):
+    '''Get the plan of a model in lazy mode, the model is prepared the first time'''
+    plan = PLANS.get(model)
+    if plan is not None:
+        return plan
+    with LOCK:
+        plan = PLANS.get(model)
+        if plan is None:
+            start = time.perf_counter()
+            # the fields are cached by model name, other classes with the label of a registered
+            # model, e.g. the historical models of migrations, are not prepared
+            if is_registered(model):
+                prepare_model(model, STATE['select_mode'])
+            # models without file fields get the empty plan so they are only prepared once
+            plan = PLANS.setdefault(model, EMPTY_PLAN)
+            STATE['lazy_models'] += 1
+            STATE['lazy_seconds'] += time.perf_counter() - start
+    return plan
+
+
+def is_registered(model):
+    '''Check if a model class is the model registered for its label'''
+    opts = model._meta
+    try:
+        return apps.get_model(opts.app_label, opts.model_name) is model
+    except LookupError:
+        return False
+
+
+def file_field_models():
+    '''
+        Get the models with file fields without preparing them, their post_delete handler is
+        connected at startup in lazy mode
+    '''
+    select_mode = STATE['select_mode']
     for model in apps.get_models():
         if ignore_model(model, select_mode):
             continue
-        name = get_model_name(model)
-        if model_has_filefields(name):  # pragma: no cover
-            continue
-        opts = model._meta
-        for field in opts.get_fields():
-            if isinstance(field, models.FileField):
-                add_field_for_model(name, field.name, field)
+        if any(isinstance(field, models.FileField) for field in model._meta.concrete_fields):
+            yield model
+
+
+def prepare_all():
+    '''Prepare the models that were not used yet in lazy mode, e.g. before listing all of them'''
+    if STATE['complete']:
+        return
+    for model in apps.get_models():
+        get_lazy_plan(model)
+    STATE['complete'] = True
 
 
 def add_field_for_model(model_name, field_name, field):
@@ -49,53 +195,108 @@ def add_field_for_model(model_name, field_name, field):
     FIELDS_FIELDS[model_name][field_name] = get_dotted_path(field)
     # also store the dotted path of the storage for the same reason
     FIELDS_STORAGE[model_name][field_name] = get_dotted_path(field.storage)
+    # the instances are reused to restore them while the model exists
+    FIELDS_INSTANCES[model_name][field_name] = (make_ref(field), make_ref(field.storage))
+
+
+def make_model_plan(model, model_name):
+    '''Compile the immutable plan of file fields for a model'''
+    fields = tuple(
+        FieldPlan(field.name, field.attname, field, field.storage, field.default)
+        for field in (model._meta.get_field(name) for name in sorted(FIELDS[model_name])))
+    return ModelPlan(
+        model_name, fields, {field.name: field for field in fields},
+        tuple(field.name for field in fields))
 
 
 # generators ##
 
 
-def get_fields_for_model(model_name, exclude=None):
-    '''Get the filefields for a model if it has them'''
-    if model_has_filefields(model_name):
-        fields = FIELDS[model_name]
+def get_plan(model):
+    '''
+        Get the plan for a model class, models without file fields get an empty plan. In lazy mode
+        a model is prepared the first time its plan is needed.
+    '''
+    plan = PLANS.get(model)
+    if plan is None:
+        return EMPTY_PLAN if STATE['complete'] else get_lazy_plan(model)
+    return plan
 
-        if exclude is not None:
-            assert isinstance(exclude, set)
-            fields = fields.difference(exclude)
 
-        for field_name in fields:
-            yield field_name
+def get_default_name(model, field_name):
+    '''
+        Get the default file name of a field. A callable default is called the first time and its
+        name is cached, unless the field is in the CLEANUP_DYNAMIC_DEFAULTS setting.
+    '''
+    key = (model, field_name)
+    if key in DEFAULT_NAMES:
+        return DEFAULT_NAMES[key]
+    plan = get_plan(model)
+    default = plan.fields_by_name[field_name].default
+    if not callable(default):
+        return default
+    default = default()
+    if f'{plan.model_name}.{field_name}' not in conf.get('DYNAMIC_DEFAULTS'):
+        DEFAULT_NAMES[key] = default
+    return default
+
+
+def clear_default_names(model=None):
+    '''Clear the cached names of callable defaults, of one model class or of all models'''
+    if model is None:
+        DEFAULT_NAMES.clear()
+        return
+    for key in [key for key in DEFAULT_NAMES if key[0] is model]:
+        del DEFAULT_NAMES[key]
 
 
-def fields_for_model_instance(instance, using=None):
+def names_for_model_instance(instance):
     '''
-        Yields (name, descriptor) for each file field given an instance
+        Yields (name, file name) for each file field given an instance
 
-        Can use the `using` kwarg to change the instance that the `FieldFile`
-        will receive.
+        Only the stored file names are read, no `FieldFile` is made. Deferred fields are not in
+        the instance `__dict__` and are skipped.
     '''
-    if using is None:
-        using = instance
-    model_name = get_model_name(instance)
+    values = instance.__dict__
+    for field in get_plan(instance.__class__).fields:
+        if field.attname in values:
+            yield field.name, get_file_name(values[field.attname])
 
-    deferred_fields = instance.get_deferred_fields()
 
-    for field_name in get_fields_for_model(model_name, exclude=deferred_fields):
-        fieldfile = getattr(instance, field_name)
-        yield field_name, fieldfile.__class__(using, fieldfile.field, fieldfile.name)
+# restore ##
 
 
-# restore ##
+def make_ref(object_):
+    '''Make a weak reference to an object, or a strong one if it does not support weak references'''
+    try:
+        return weakref.ref(object_)
+    except TypeError:
+        return lambda: object_
 
 
 def get_field(model_name, field_name):
-    '''Restore a field from its dotted path'''
-    return import_string(FIELDS_FIELDS[model_name][field_name])
+    '''
+        Restore a field, the field instance of the model, or a new field made from its dotted path
+        if the model is gone
+    '''
+    refs = FIELDS_INSTANCES[model_name].get(field_name)
+    field = refs[0]() if refs is not None else None
+    if field is None:
+        field = import_string(FIELDS_FIELDS[model_name][field_name])()
+        field.name = field_name
+    return field
 
 
 def get_field_storage(model_name, field_name):
-    '''Restore a storage from its dotted path'''
-    return import_string(FIELDS_STORAGE[model_name][field_name])
+    '''
+        Restore a storage, the storage instance of the field, or a new storage made from its
+        dotted path if the field is gone
+    '''
+    refs = FIELDS_INSTANCES[model_name].get(field_name)
+    storage = refs[1]() if refs is not None else None
+    if storage is None:
+        storage = import_string(FIELDS_STORAGE[model_name][field_name])()
+    return storage
 
 
 # utilities ##
@@ -107,6 +308,13 @@ def get_dotted_path(object_):
     return f'{klass.__module__}.{klass.__qualname__}'
 
 
+def get_file_name(value):
+    '''returns the file name for a raw file field value, a string, `File` or None'''
+    if value is None or value.__class__ is str:
+        return value
+    return getattr(value, 'name', value)
+
+
 def get_model_name(model):
     '''returns a unique model name'''
     opt = model._meta
@@ -125,6 +333,12 @@ def get_mangled_select(model):
     return f'_{opt.model_name}__{opt.app_label}_cleanup_select'
 
 
+def get_mangled_fast_delete(model):
+    '''returns a mangled attribute name specific to the model for fast delete functionality'''
+    opt = model._meta
+    return f'_{opt.model_name}__{opt.app_label}_cleanup_fast_delete'
+
+
 # booleans ##
 
 
@@ -139,6 +353,13 @@ def ignore_model(model, select_mode):
         if select_mode else hasattr(model, get_mangled_ignore(model)))
 
 
+def is_fast_delete(model):
+    '''Check if the rows of a model are deleted without a post_delete handler'''
+    return (
+        STATE['fast_delete'] and hasattr(model, get_mangled_fast_delete(model)) and
+        model not in FAST_DELETE_BLOCKED)
+
+
 # instance functions ##
 
 
@@ -150,15 +371,58 @@ def remove_instance_cache(instance):
 
 def make_cleanup_cache(instance, source=None):
     '''
-        Make the cleanup cache for an instance.
+        Make the cleanup cache for an instance, a `Snapshot` of the original file names.
 
         Can also change the source of the data with the `source` kwarg.
     '''
 
     if source is None:
         source = instance
-    setattr(instance, CACHE_NAME, dict(
-        fields_for_model_instance(source, using=instance)))
+    values = source.__dict__
+    plan = get_plan(instance.__class__)
+    try:
+        # the field names are shared by the snapshots of the model unless fields are deferred
+        snapshot = Snapshot(
+            plan.names, tuple([get_file_name(values[field.attname]) for field in plan.fields]))
+    except KeyError:
+        fields = [field for field in plan.fields if field.attname in values]
+        snapshot = Snapshot(
+            tuple(field.name for field in fields),
+            tuple(get_file_name(values[field.attname]) for field in fields))
+    setattr(instance, CACHE_NAME, snapshot)
+    backend = metrics.get_backend()
+    if backend is not None:
+        backend.increment('snapshots', tags={'model_name': plan.model_name})
+
+
+def is_readonly():
+    '''Check if instances are being loaded in a readonly context'''
+    return READONLY.get()
+
+
+def fetch_original_names(model, pks, using=None):
+    '''
+        Fetch only the file field columns of rows from the database, returns a dict of pk to a dict
+        of field name to file name.
+    '''
+    fields = get_plan(model).fields
+    names = [field.name for field in fields]
+    attnames = [field.attname for field in fields]
+    using = using or router.db_for_read(model)
+    pks = list(pks)
+    batch_size = max(connections[using].ops.bulk_batch_size(['pk'], pks), 1)
+    originals = {}
+    for start in range(0, len(pks), batch_size):
+        rows = model._base_manager.using(using).filter(
+            pk__in=pks[start:start + batch_size]).values_list('pk', *attnames)
+        for pk, *values in rows:
+            originals[pk] = dict(zip(names, values))
+    return originals
+
+
+def set_cleanup_cache(instance, names):
+    '''Set the cleanup cache of an instance from a dict of field name to file name'''
+    setattr(instance, CACHE_NAME, Snapshot(tuple(names), tuple(names.values())))
 
 
 def has_cache(instance):
@@ -166,9 +430,28 @@ def has_cache(instance):
     return hasattr(instance, CACHE_NAME)
 
 
-def get_field_attr(instance, field_name):
-    '''Get a value from the cache on an instance'''
-    return getattr(instance, CACHE_NAME)[field_name]
+def get_cache(instance):
+    '''
+        Get the cache on an instance. Instances pickled by earlier versions hold a dict of field
+        name to `FieldFile`, it is replaced with a `Snapshot` of the file names.
+    '''
+    snapshot = getattr(instance, CACHE_NAME)
+    if snapshot.__class__ is not Snapshot:
+        snapshot = Snapshot(
+            tuple(snapshot), tuple(get_file_name(value) for value in snapshot.values()))
+        setattr(instance, CACHE_NAME, snapshot)
+    return snapshot
+
+
+def get_original_name(instance, field_name):
+    '''Get an original file name from the cache on an instance'''
+    return get_cache(instance)[field_name]
+
+
+def make_field_file(instance, field_name, name):
+    '''Make a `FieldFile` for a file name, only done when a file needs to be deleted'''
+    field = get_plan(instance.__class__).fields_by_name[field_name].field
+    return field.attr_class(instance, field, name)
 
 
 # data sharing ##
@@ -176,10 +459,25 @@ def get_field_attr(instance, field_name):
 
 def cleanup_models():
     '''Get all the models we have in the FIELDS cache'''
-    for model_name in FIELDS:
+    prepare_all()
+    for model_name in list(FIELDS):
         yield apps.get_model(model_name)
 
 
 def cleanup_fields():
     '''Get a copy of the FIELDS cache'''
+    prepare_all()
     return FIELDS.copy()
+
+
+def unique_columns(model_fields):
+    '''
+        Yields the (model, field) pairs whose column was not yielded yet, proxies and unmanaged
+        models can share the table of another model so each column is read once
+    '''
+    columns = set()
+    for model, field in model_fields:
+        column = (model._meta.db_table, field.column)
+        if column not in columns:
+            columns.add(column)
+            yield model, field
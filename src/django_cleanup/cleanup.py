@@ -1,10 +1,22 @@
 '''Public utilities'''
+from contextlib import contextmanager
+
 from .cache import (
-    get_mangled_ignore as _get_mangled_ignore, get_mangled_select as _get_mangled_select,
-    make_cleanup_cache as _make_cleanup_cache)
+    READONLY as _READONLY, STARTUP as _STARTUP, STATE as _STATE,
+    clear_default_names as _clear_default_names, fetch_original_names as _fetch_original_names,
+    get_mangled_fast_delete as _get_mangled_fast_delete, get_mangled_ignore as _get_mangled_ignore,
+    get_mangled_select as _get_mangled_select, make_cleanup_cache as _make_cleanup_cache,
+    set_cleanup_cache as _set_cleanup_cache)
+from .deletion import (
+    DRY_RUN as _DRY_RUN, DRY_RUN_PLAN as _DRY_RUN_PLAN, DeletionPlan as _DeletionPlan)
+from .handlers import fast_delete_method as _fast_delete_method
+from .profiling import PROFILE as _PROFILE, SETTING_PROFILE as _SETTING_PROFILE, Profile as _Profile
 
 
-__all__ = ['refresh', 'cleanup_ignore', 'cleanup_select']
+__all__ = [
+    'refresh', 'refresh_from_db', 'readonly', 'dry_run', 'dry_run_plan', 'profile',
+    'profile_report', 'refresh_defaults', 'startup_report', 'cleanup_ignore', 'cleanup_select',
+    'cleanup_fast_delete']
 
 
 def refresh(instance):
@@ -12,6 +24,93 @@ def refresh(instance):
     return _make_cleanup_cache(instance)
 
 
+def refresh_from_db(instances, using=None):
+    '''
+        Refresh the cache for many instances from the database with one query per model, e.g.
+        before saving instances that were built with a pk or unpickled.
+    '''
+    by_model = {}
+    for instance in instances:
+        if instance.pk is not None:
+            by_model.setdefault(instance.__class__, []).append(instance)
+    for model, model_instances in by_model.items():
+        originals = _fetch_original_names(
+            model, [instance.pk for instance in model_instances], using)
+        for instance in model_instances:
+            names = originals.get(instance.pk)
+            if names is not None:
+                _set_cleanup_cache(instance, names)
+
+
+def refresh_defaults(model=None):
+    '''
+        Call the callable defaults again the next time a default file name is needed, e.g. after
+        changing what they return. Clears the names of one model class or of all models.
+    '''
+    _clear_default_names(model)
+
+
+@contextmanager
+def readonly():
+    '''
+        Instances loaded within this context do not get a cleanup cache.
+
+        If one of them is saved anyway, the cache is made from the database in pre_save.
+    '''
+    token = _READONLY.set(True)
+    try:
+        yield
+    finally:
+        _READONLY.reset(token)
+
+
+@contextmanager
+def dry_run():
+    '''
+        Files are not deleted within this context, the yielded `DeletionPlan` records the deletions
+        of each transaction that commits and `cleanup_pre_delete` is sent with `dry_run=True`.
+    '''
+    plan = _DeletionPlan()
+    token = _DRY_RUN.set(plan)
+    try:
+        yield plan
+    finally:
+        _DRY_RUN.reset(token)
+
+
+def dry_run_plan():
+    '''Get the `DeletionPlan` of the CLEANUP_DRY_RUN setting, it keeps the last 1000 transactions'''
+    return _DRY_RUN_PLAN
+
+
+@contextmanager
+def profile():
+    '''
+        Profile the handlers within this context, the yielded `Profile` holds the time of each
+        handler per model and its `report()` lists them sorted, most time first.
+    '''
+    profile_ = _Profile()
+    token = _PROFILE.set(profile_)
+    try:
+        yield profile_
+    finally:
+        _PROFILE.reset(token)
+
+
+def profile_report():
+    '''Get the sorted report of the handler times collected with the CLEANUP_PROFILE setting'''
+    return _SETTING_PROFILE.report()
+
+
+def startup_report():
+    '''
+        Get the startup timing, the mode, the seconds to prepare the cache and to connect the
+        handlers, and in lazy mode the number of models prepared on first use and their seconds.
+    '''
+    return {
+        **_STARTUP, 'lazy_models': _STATE['lazy_models'], 'lazy_seconds': _STATE['lazy_seconds']}
+
+
 def ignore(cls):
     '''Mark a model to ignore for cleanup'''
     setattr(cls, _get_mangled_ignore(cls), None)
@@ -24,3 +123,15 @@ def select(cls):
     setattr(cls, _get_mangled_select(cls), None)
     return cls
 cleanup_select = select
+
+
+def fast_delete(cls):
+    '''
+        Mark a model to keep the fast delete of the ORM, it gets no post_delete handler. The base
+        manager of the model must use `CleanupQuerySet`, the files of the rows that querysets and
+        cascades delete without loading them are read first, see `CleanupQuerySetMixin`.
+    '''
+    setattr(cls, _get_mangled_fast_delete(cls), None)
+    cls.delete = _fast_delete_method(cls.delete)
+    return cls
+cleanup_fast_delete = fast_delete
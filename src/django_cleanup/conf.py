@@ -0,0 +1,46 @@
+'''
+    Settings for django-cleanup, every setting is optional and is prefixed with `CLEANUP_` in the
+    django settings.
+'''
+from django.conf import settings
+
+
+DEFAULTS = {
+    # dotted path of the class that deletes chunks of files on a storage
+    'BULK_DELETER': 'django_cleanup.deletion.BulkDeleter',
+    # where chunks of files are deleted, one of 'inline', 'thread' or 'process'
+    'EXECUTOR': 'inline',
+    # the max number of workers of a 'thread' or 'process' executor
+    'EXECUTOR_WORKERS': 4,
+    # delete files as tasks on the event loop when saved or deleted from an async context
+    'ASYNC': False,
+    # the max number of concurrent async deletions per event loop
+    'ASYNC_CONCURRENCY': 10,
+    # 'app_label.model_name' of models that never need the cache remade from the database in
+    # pre_save, instances of these models without a cache do not delete their old files
+    'NO_FALLBACK_MODELS': (),
+    # a spool directory, when set deletions are written there for the cleanup_worker command
+    'QUEUE_PATH': None,
+    # the number of files a transaction keeps in memory until it commits, beyond it they are
+    # written to a temporary file, None keeps every file in memory
+    'SPILL_THRESHOLD': None,
+    # record the deletions in `cleanup.dry_run_plan()` instead of deleting the files
+    'DRY_RUN': False,
+    # dotted path of a metrics backend class, e.g. 'django_cleanup.metrics.InMemoryBackend'
+    'METRICS_BACKEND': None,
+    # add the time of each handler per model to `cleanup.profile_report()`
+    'PROFILE': False,
+    # 'app_label.model_name.field_name' of fields with a callable default that must be called
+    # for every file, the default file names of other fields are cached
+    'DYNAMIC_DEFAULTS': (),
+    # prepare each model on its first signal instead of every model at startup
+    'LAZY': False,
+    # how the handlers are connected, 'model' connects four receivers per cleanup model, 'single'
+    # one receiver per signal for all models, lazy mode is always 'single'
+    'DISPATCH': 'model',
+}
+
+
+def get(name):
+    '''Get a setting or its default'''
+    return getattr(settings, f'CLEANUP_{name}', DEFAULTS[name])
@@ -0,0 +1,127 @@
+'''
+    Find rows of the cleanup models whose files no longer exist on their storage. Rows are read as
+    (pk, name) pages ordered by pk, the distinct names of a page are checked with `storage.exists`
+    in a thread pool, and the rows with missing files are appended to a report. A checkpoint is
+    written after each page so an interrupted run resumes where it stopped.
+'''
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+
+from . import cache
+
+
+class RecentNames:
+    '''The results of the last `size` checked names, rows often share a file name'''
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.results = OrderedDict()
+
+    def get(self, key):
+        exists = self.results.get(key)
+        if exists is not None:
+            self.results.move_to_end(key)
+        return exists
+
+    def set(self, key, exists):
+        self.results[key] = exists
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+
+def iter_fields():
+    '''Yields (field label, model, field plan) for the file fields of the cleanup models'''
+    fields = []
+    for model_name, field_names in sorted(cache.cleanup_fields().items()):
+        model = apps.get_model(model_name)
+        fields += [(model, model._meta.get_field(name)) for name in sorted(field_names)]
+    for model, field in cache.unique_columns(fields):
+        plan = cache.get_plan(model)
+        yield f'{plan.model_name}.{field.name}', model, plan.fields_by_name[field.name]
+
+
+def iter_pages(model, field, using=None, after=None, chunk_size=2000):
+    '''Yields lists of (pk, name) ordered by pk, after the pk `after` when it is given'''
+    queryset = model._base_manager.using(using).exclude(
+        **{f'{field.attname}__isnull': True}).exclude(**{field.attname: ''}).order_by('pk')
+    while True:
+        page = queryset if after is None else queryset.filter(pk__gt=after)
+        rows = list(page.values_list('pk', field.attname)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][0]
+
+
+def find_missing(executor, storage, rows, recent):
+    '''Get the (pk, name) rows whose file does not exist, each name is checked once'''
+    results = {}
+    unchecked = []
+    for _, name in rows:
+        if name not in results:
+            results[name] = recent.get((id(storage), name))
+            if results[name] is None:
+                unchecked.append(name)
+    for name, exists in zip(unchecked, executor.map(storage.exists, unchecked)):
+        results[name] = exists
+        recent.set((id(storage), name), exists)
+    return [(pk, name) for pk, name in rows if not results[name]]
+
+
+def get_checkpoint_path(report_path):
+    return f'{report_path}.checkpoint'
+
+
+def load_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as file_:
+            return json.load(file_)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, state):
+    '''Replace the checkpoint atomically, a crash leaves either the old or the new checkpoint'''
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file_:
+        json.dump(state, file_, default=str)
+    os.replace(tmp_path, path)
+
+
+def check(report_path, using=None, chunk_size=2000, workers=8, cache_size=100000, restart=False):
+    '''
+        Append a json line of field, pk and name to the report for each row whose file is missing,
+        returns the state of the run with the number of rows checked and files missing.
+
+        The checkpoint next to the report holds the last pk checked of each field and the size of
+        the report at that point. A resumed run truncates the report to that size, so rows of a
+        page that was not checkpointed are not reported twice.
+    '''
+    checkpoint_path = get_checkpoint_path(report_path)
+    state = None if restart else load_checkpoint(checkpoint_path)
+    if state is None:
+        state = {'fields': {}, 'offset': 0, 'rows': 0, 'missing': 0}
+    recent = RecentNames(cache_size)
+    with open(report_path, 'ab') as report, ThreadPoolExecutor(max(workers, 1)) as executor:
+        report.truncate(state['offset'])
+        for label, model, field in iter_fields():
+            progress = state['fields'].setdefault(label, {'after': None, 'done': False})
+            if progress['done']:
+                continue
+            for rows in iter_pages(model, field, using, progress['after'], chunk_size):
+                for pk, name in find_missing(executor, field.storage, rows, recent):
+                    line = json.dumps({'field': label, 'pk': pk, 'name': name}, default=str)
+                    report.write(f'{line}\n'.encode())
+                    state['missing'] += 1
+                report.flush()
+                progress['after'] = rows[-1][0]
+                state['rows'] += len(rows)
+                state['offset'] = report.tell()
+                save_checkpoint(checkpoint_path, state)
+            progress['done'] = True
+            save_checkpoint(checkpoint_path, state)
+    return state
@@ -0,0 +1,644 @@
+'''
+    Batched file deletion. Files queued for deletion in a transaction are collected in a single
+    on_commit callback, grouped per storage, deduplicated and deleted in chunks.
+'''
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import weakref
+from collections import Counter, deque, namedtuple
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import partial
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from asgiref.sync import SyncToAsync, sync_to_async
+
+from . import cache, conf, metrics, spool
+from .references import index
+from .signals import (
+    cleanup_post_delete, cleanup_post_delete_batch, cleanup_pre_delete, cleanup_pre_delete_batch)
+
+
+# errors are logged on the handlers logger, where deletions were logged before batching
+logger = logging.getLogger('django_cleanup.handlers')
+
+
+try:
+    from storages.utils import clean_name
+except ImportError:  # pragma: no cover
+    def clean_name(name):
+        return name
+
+
+class FakeInstance:
+    '''A Fake model instance to ensure an instance is not modified'''
+
+
+# a file to delete when a transaction commits, `instance` is a weak reference to the instance that
+# was saved or deleted or None, the instance is not kept alive until the commit
+DeletionRecord = namedtuple(
+    'DeletionRecord',
+    ['storage', 'file_name', 'model_name', 'field_name', 'reason', 'pk', 'instance'])
+
+
+def make_record(storage, file_name, model_name, field_name, reason, pk, instance=None):
+    '''Make the record of a file to delete'''
+    return DeletionRecord(
+        storage, file_name, model_name, field_name, reason, pk,
+        None if instance is None else weakref.ref(instance))
+
+
+def make_events(records):
+    '''
+        Make the (sender, cleanup signal kwargs) of records, the instance is None if it was garbage
+        collected before the commit
+    '''
+    items = []
+    for record in records:
+        model = apps.get_model(record.model_name)
+        field = cache.get_field(record.model_name, record.field_name)
+        file_ = field.attr_class(FakeInstance(), field, record.file_name)
+        file_.storage = record.storage
+        items.append((model, {
+            'deleted': record.reason == 'deleted',
+            'model_name': record.model_name,
+            'field_name': record.field_name,
+            'file_name': record.file_name,
+            'default_file_name': cache.get_default_name(model, record.field_name),
+            'file': file_,
+            'instance': None if record.instance is None else record.instance(),
+            'updated': record.reason == 'updated'
+        }))
+    return items
+
+
+def has_listeners(storage, records):
+    '''
+        Check which cleanup signals have receivers for the files of a storage, a tuple of the per
+        file signals and of the batch signals. The signal kwargs are only made if one does.
+    '''
+    models = [apps.get_model(name) for name in {record.model_name for record in records}]
+    return (
+        any(cleanup_pre_delete.has_listeners(model) or cleanup_post_delete.has_listeners(model)
+            for model in models),
+        cleanup_pre_delete_batch.has_listeners(storage.__class__) or
+        cleanup_post_delete_batch.has_listeners(storage.__class__))
+
+
+class PostDeleteBatch:
+    '''
+        The events of the chunks of files of a storage, `cleanup_post_delete_batch` is sent once
+        every chunk is done. Chunks can finish in the threads of an executor.
+    '''
+
+    def __init__(self, storage, chunks):
+        self.storage = storage
+        self.pending = chunks
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, items, errors):
+        with self.lock:
+            for _, event in items:
+                error = errors.get(event['file_name'])
+                self.events.append({**event, 'error': error, 'success': error is None})
+            self.pending -= 1
+            if self.pending:
+                return
+        cleanup_post_delete_batch.send(
+            sender=self.storage.__class__, storage=self.storage, events=self.events)
+
+
+class BulkDeleter:
+    '''Deletes a chunk of files on a storage one file at a time'''
+
+    chunk_size = 1000
+
+    def delete(self, storage, names):
+        '''Delete the names on the storage, returns a dict of name to error for failed deletions'''
+        errors = {}
+        for name in names:
+            try:
+                storage.delete(name)
+            except Exception as ex:
+                errors[name] = ex
+        return errors
+
+
+class S3BulkDeleter(BulkDeleter):
+    '''
+        Deletes a chunk of files with the multi-object delete of a django-storages S3 storage, other
+        storages are deleted one file at a time.
+    '''
+
+    chunk_size = 1000
+
+    def delete(self, storage, names):
+        bucket = getattr(storage, 'bucket', None)
+        if bucket is None:
+            return super().delete(storage, names)
+
+        keys = {storage._normalize_name(clean_name(name)): name for name in names}
+        response = bucket.delete_objects(Delete={
+            'Objects': [{'Key': key} for key in keys],
+            'Quiet': True
+        })
+        return {
+            keys[error['Key']]: Exception(f"{error.get('Code')}: {error.get('Message')}")
+            for error in response.get('Errors', ())
+        }
+
+
+def get_deleter():
+    '''Make the configured bulk deleter'''
+    return import_string(conf.get('BULK_DELETER'))()
+
+
+class InlineExecutor(Executor):
+    '''Runs deletions immediately in the thread that commits'''
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+
+
+EXECUTOR_CLASSES = {
+    'inline': InlineExecutor,
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+EXECUTORS = {}
+EXECUTORS_LOCK = threading.Lock()
+
+
+def get_executor():
+    '''Get the configured executor that deletes chunks of files, made once per configuration'''
+    config = (conf.get('EXECUTOR'), conf.get('EXECUTOR_WORKERS'))
+    executor = EXECUTORS.get(config)
+    if executor is not None:
+        return executor
+
+    kind, workers = config
+    if kind not in EXECUTOR_CLASSES:
+        raise ImproperlyConfigured(
+            f'CLEANUP_EXECUTOR must be one of {", ".join(EXECUTOR_CLASSES)}, not {kind!r}')
+    with EXECUTORS_LOCK:
+        if config not in EXECUTORS:
+            EXECUTORS[config] = (
+                InlineExecutor() if kind == 'inline' else EXECUTOR_CLASSES[kind](workers))
+        return EXECUTORS[config]
+
+
+def shutdown_executors(wait=True):
+    '''Shutdown the executors, waiting for their pending deletions by default'''
+    with EXECUTORS_LOCK:
+        executors = list(EXECUTORS.values())
+        EXECUTORS.clear()
+    for executor in executors:
+        executor.shutdown(wait=wait)
+
+
+# the semaphore bounding the async deletions of each event loop
+SEMAPHORES = weakref.WeakKeyDictionary()
+# futures of the async deletions that are not done
+PENDING = set()
+# the tasks of the async deletions, a loop only keeps weak references to tasks
+TASKS = set()
+
+
+def get_event_loop():
+    '''
+        Get the event loop of the async context that called the current sync code through
+        `sync_to_async`, e.g. `asave()` and `adelete()`, None when not called from an async context.
+    '''
+    threadlocal = SyncToAsync.threadlocal
+    loop = getattr(threadlocal, 'main_event_loop', None)
+    if (loop is None or loop.is_closed() or not loop.is_running()
+            or getattr(threadlocal, 'main_event_loop_pid', None) != os.getpid()):
+        return None
+    return loop
+
+
+def get_semaphore():
+    '''Get the semaphore of the running event loop'''
+    loop = asyncio.get_running_loop()
+    semaphore = SEMAPHORES.get(loop)
+    if semaphore is None:
+        semaphore = SEMAPHORES[loop] = asyncio.Semaphore(conf.get('ASYNC_CONCURRENCY'))
+    return semaphore
+
+
+def submit_task(loop, coro):
+    '''
+        Start a coroutine as a task on an event loop from another thread, returns a
+        `concurrent.futures.Future` of its result. The task runs in an empty context so it does not
+        inherit the `sync_to_async` state of the calling thread.
+    '''
+    future = Future()
+
+    def copy_result(task):
+        TASKS.discard(task)
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        task = loop.create_task(coro)
+        TASKS.add(task)
+        task.add_done_callback(copy_result)
+
+    PENDING.add(future)
+    future.add_done_callback(PENDING.discard)
+    loop.call_soon_threadsafe(start, context=contextvars.Context())
+    return future
+
+
+async def wait_async():
+    '''Wait for the pending async deletions'''
+    await asyncio.gather(*(asyncio.wrap_future(future) for future in list(PENDING)))
+
+
+# a file deletion planned in dry run mode
+PlannedDeletion = namedtuple(
+    'PlannedDeletion', ['storage', 'file_name', 'model_name', 'field_name', 'reason', 'pk'])
+
+
+class DeletionPlan:
+    '''
+        The deletions planned in dry run mode. `transactions` holds the list of planned deletions of
+        each committed transaction, the last `max_transactions` are kept, `counts` counts all the
+        planned deletions per (model name, field name).
+    '''
+
+    def __init__(self, max_transactions=None):
+        self.transactions = deque(maxlen=max_transactions)
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, deletions):
+        with self.lock:
+            self.transactions.append(deletions)
+            self.counts.update(
+                (deletion.model_name, deletion.field_name) for deletion in deletions)
+
+    @property
+    def deletions(self):
+        '''All the planned deletions that are kept'''
+        with self.lock:
+            return [deletion for deletions in self.transactions for deletion in deletions]
+
+    def clear(self):
+        with self.lock:
+            self.transactions.clear()
+            self.counts.clear()
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+
+# the plan of the `cleanup.dry_run` context, see `get_dry_run_plan`
+DRY_RUN = ContextVar('django_cleanup_dry_run', default=None)
+# the plan used with the CLEANUP_DRY_RUN setting
+DRY_RUN_PLAN = DeletionPlan(max_transactions=1000)
+
+
+def get_dry_run_plan():
+    '''Get the plan that deletions are recorded in, None when files are deleted'''
+    plan = DRY_RUN.get()
+    if plan is None and conf.get('DRY_RUN'):
+        return DRY_RUN_PLAN
+    return plan
+
+
+# the most temporary files the spilled records of a batch are split into at its commit, the
+# buckets are larger than the spill threshold beyond it
+SPILL_BUCKETS = 64
+
+
+class Batch:
+    '''
+        The files to delete when a transaction commits, registered as one on_commit callback. The
+        files are kept as `DeletionRecord`, beyond the CLEANUP_SPILL_THRESHOLD setting they are
+        written to a temporary file until the commit.
+    '''
+
+    # the deletion plan of a dry run batch
+    plan = None
+
+    def __init__(self, using=None, deleted=None):
+        self.using = using
+        # storage -> file name -> record
+        self.storages = {}
+        self.size = 0
+        self.spill_threshold = conf.get('SPILL_THRESHOLD')
+        # the temporary file of the spilled records and the storages they reference by index
+        self.spill_file = None
+        self.spill_storages = []
+        self.spilled = 0
+        # storage -> file names deleted by the batches of the same transaction
+        self.deleted = {} if deleted is None else deleted
+
+    def add(self, record):
+        '''Add a file to the batch, a file name is only deleted once per storage'''
+        files = self.storages.setdefault(record.storage, {})
+        if record.file_name in files:
+            return
+        files[record.file_name] = record
+        self.size += 1
+        if self.spill_threshold and self.size >= self.spill_threshold:
+            self.spill()
+
+    def spill(self):
+        '''Write the records to the temporary file, the instances are not kept'''
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        for storage, files in self.storages.items():
+            if storage not in self.spill_storages:
+                self.spill_storages.append(storage)
+            key = self.spill_storages.index(storage)
+            for record in files.values():
+                self.spill_file.write(json.dumps([key, *record[1:6]], default=str))
+                self.spill_file.write('\n')
+        self.spilled += self.size
+        self.storages = {}
+        self.size = 0
+
+    def buckets(self):
+        '''
+            Split the spilled records by the hash of their storage and file name into temporary
+            files of about the spill threshold, so each file name is in one bucket
+        '''
+        count = min(-(-self.spilled // self.spill_threshold), SPILL_BUCKETS)
+        if count <= 1:
+            buckets = [self.spill_file]
+        else:
+            buckets = [tempfile.TemporaryFile('w+', encoding='utf-8') for _ in range(count)]
+            self.spill_file.seek(0)
+            for line in self.spill_file:
+                key, name = json.loads(line)[:2]
+                buckets[hash((key, name)) % count].write(line)
+            self.spill_file.close()
+        self.spill_file = None
+        self.spilled = 0
+        return buckets
+
+    def segments(self):
+        '''
+            Yields the records in dicts of storage -> file name -> record. The records of a batch
+            that spilled are all written to disk and read back one bucket at a time, which removes
+            the duplicate file names without keeping every name in memory. The pk of a spilled
+            record is read as it was written to JSON.
+        '''
+        if self.spill_file is None:
+            yield self.storages
+            return
+        self.spill()
+        for bucket in self.buckets():
+            bucket.seek(0)
+            storages = {}
+            for line in bucket:
+                key, *fields = json.loads(line)
+                files = storages.setdefault(self.spill_storages[key], {})
+                if fields[0] not in files:
+                    files[fields[0]] = DeletionRecord(self.spill_storages[key], *fields, None)
+            bucket.close()
+            yield storages
+
+    def remove_referenced(self):
+        '''Remove the files that the reference index shows are still used by other rows'''
+        for files in self.storages.values():
+            by_storage = {}
+            for name, record in files.items():
+                storage = index.get_storage(record.model_name, record.field_name)
+                by_storage.setdefault(storage, []).append(name)
+            for storage, names in by_storage.items():
+                for name in index.referenced(storage, names, self.using):
+                    del files[name]
+
+    def remove_deleted(self, record=True):
+        '''
+            Remove the files an earlier batch of the transaction deleted, record the others unless
+            `record` is false
+        '''
+        for storage, files in self.storages.items():
+            deleted = self.deleted.setdefault(storage, set())
+            for name in deleted.intersection(files):
+                del files[name]
+            if record:
+                deleted.update(files)
+
+    def __call__(self):
+        # the names of a spilled batch are not kept for the later batches of the transaction,
+        # which may delete them again
+        spilled = self.spill_file is not None
+        for storages in self.segments():
+            self.storages = storages
+            self.remove_deleted(record=not spilled)
+            if index.enabled():
+                self.remove_referenced()
+            self.run()
+        self.storages = {}
+
+    def run(self):
+        '''Delete the files of a segment'''
+        queue_path = conf.get('QUEUE_PATH')
+        if queue_path:
+            spool.write(queue_path, [
+                spool.make_record(record)
+                for files in self.storages.values() for record in files.values()])
+            return
+
+        deleter = get_deleter()
+        loop = get_event_loop() if conf.get('ASYNC') else None
+        executor = get_executor() if loop is None else None
+        size = deleter.chunk_size
+        for storage, files in self.storages.items():
+            if not files:
+                # every file was removed as deleted earlier, referenced or a duplicate
+                continue
+            records = list(files.values())
+            per_file, batch = has_listeners(storage, records)
+            items = make_events(records) if per_file or batch else None
+            post_batch = None
+            if batch:
+                cleanup_pre_delete_batch.send(
+                    sender=storage.__class__, storage=storage,
+                    events=[event for _, event in items])
+                post_batch = PostDeleteBatch(storage, -(-len(records) // size))
+            for start in range(0, len(records), size):
+                delete_chunk(
+                    executor, deleter, storage, records[start:start + size], loop,
+                    items and items[start:start + size], post_batch)
+
+
+class DryRunBatch(Batch):
+    '''
+        The files that would be deleted when a transaction commits, they are recorded in a deletion
+        plan and `cleanup_pre_delete` is sent with `dry_run=True`.
+    '''
+
+    def __init__(self, plan, using=None, deleted=None):
+        super().__init__(using, deleted)
+        self.plan = plan
+
+    def __call__(self):
+        self.deletions = []
+        super().__call__()
+        self.plan.add(self.deletions)
+        self.deletions = []
+
+    def run(self):
+        for storage, files in self.storages.items():
+            records = list(files.values())
+            self.deletions += [PlannedDeletion(*record[:6]) for record in records]
+            per_file, batch = has_listeners(storage, records)
+            if not records or not per_file and not batch:
+                continue
+            items = make_events(records)
+            for sender, event in items:
+                cleanup_pre_delete.send(sender=sender, dry_run=True, **event)
+            cleanup_pre_delete_batch.send(
+                sender=storage.__class__, storage=storage, events=[event for _, event in items],
+                dry_run=True)
+
+
+def delete_chunk(executor, deleter, storage, records, loop=None, items=None, post_batch=None):
+    '''
+        Hand a chunk of files on one storage to the executor, or to the event loop as a task when
+        one is given. `cleanup_pre_delete` is sent for each file before the chunk is submitted,
+        `cleanup_post_delete` when the chunk is done. `items` are the (sender, signal kwargs) of
+        the records, None if no receiver needs them.
+    '''
+    for sender, event in items or ():
+        cleanup_pre_delete.send(sender=sender, **event)
+
+    names = [record.file_name for record in records]
+    start = time.perf_counter()
+    if loop is not None:
+        submit_task(
+            loop, adelete_chunk(deleter, storage, records, names, start, items, post_batch))
+        return
+    future = executor.submit(deleter.delete, storage, names)
+    if isinstance(executor, InlineExecutor):
+        # the errors of the post delete receivers are raised in the committing thread
+        finish_chunk(records, start, items, post_batch, future)
+        return
+    # concurrent.futures logs the errors raised in a done callback instead of raising them, so the
+    # errors of the post delete receivers of a pool are only logged
+    future.add_done_callback(partial(finish_chunk, records, start, items, post_batch))
+
+
+async def adelete_chunk(
+        deleter, storage, records, names, start=None, items=None, post_batch=None):
+    '''
+        Delete a chunk of files from an event loop. Storages with an async `adelete` method are
+        awaited directly, other storages are deleted by the deleter in a thread.
+    '''
+    semaphore = get_semaphore()
+    adelete = getattr(storage, 'adelete', None)
+    if inspect.iscoroutinefunction(adelete):
+        async def adelete_name(name):
+            async with semaphore:
+                await adelete(name)
+        results = await asyncio.gather(
+            *(adelete_name(name) for name in names), return_exceptions=True)
+        errors = {
+            name: result for name, result in zip(names, results) if isinstance(result, Exception)}
+    else:
+        async with semaphore:
+            try:
+                errors = await sync_to_async(deleter.delete, thread_sensitive=False)(storage, names)
+            except Exception as ex:
+                errors = dict.fromkeys(names, ex)
+    await sync_to_async(finish_items)(records, errors, start, items, post_batch)
+
+
+def finish_chunk(records, start, items, post_batch, future):
+    '''Get the errors of a chunk deleted by an executor and finish it'''
+    try:
+        errors = future.result()
+    except Exception as ex:
+        errors = {record.file_name: ex for record in records}
+    finish_items(records, errors, start, items, post_batch)
+
+
+def finish_items(records, errors, start=None, items=None, post_batch=None):
+    '''
+        Log the errors of a deleted chunk and send `cleanup_post_delete` for each file, `start` is
+        the `time.perf_counter()` when the chunk was submitted
+    '''
+    backend = metrics.get_backend()
+    if backend is not None and start is not None:
+        metrics.deletions_done(backend, [
+            (record.file_name, record.model_name, record.field_name) for record in records],
+            errors, time.perf_counter() - start)
+    for record in records:
+        error = errors.get(record.file_name)
+        if error is not None:
+            logger.error(
+                'There was an exception deleting the file `%s` on field `%s.%s`',
+                record.file_name, record.model_name, record.field_name, exc_info=error)
+    for sender, event in items or ():
+        error = errors.get(event['file_name'])
+        cleanup_post_delete.send(sender=sender, error=error, success=error is None, **event)
+    if post_batch is not None:
+        post_batch.add(items, errors)
+
+
+def get_batches(using):
+    '''
+        Get the batch of the current transaction that files can be added to and the last batch of
+        the transaction. A batch can take files if every savepoint that is open now was open when it
+        was registered, so a savepoint rollback discards the batch along with the files added to it.
+        Savepoints released since it was registered can no longer be rolled back.
+    '''
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        return None, None
+    for sids, func, *_ in reversed(connection.run_on_commit):
+        if isinstance(func, Batch):
+            return (func if sids.issuperset(connection.savepoint_ids) else None), func
+    return None, None
+
+
+def schedule(record, using):
+    '''
+        Queue a `DeletionRecord` for deletion after a successful commit, assuming you are in a
+        transaction and on a database that supports transactions, otherwise it is deleted
+        immediately.
+
+        Files are coalesced per transaction, each (storage, name) is deleted at most once per
+        commit however many times it is replaced, and a new on_commit callback is only
+        registered when a savepoint was opened since the last one.
+    '''
+    backend = metrics.get_backend()
+    if backend is not None:
+        backend.increment('deletions_queued', tags={
+            'model_name': record.model_name, 'field_name': record.field_name})
+    plan = get_dry_run_plan()
+    batch, last = get_batches(using)
+    if batch is not None and batch.plan is plan:
+        batch.add(record)
+        return
+    deleted = last.deleted if last is not None and last.plan is plan else None
+    batch = Batch(using, deleted) if plan is None else DryRunBatch(plan, using, deleted)
+    batch.add(record)
+    transaction.on_commit(batch, using)
@@ -1,65 +1,157 @@
 '''
     Signal handlers to manage FileField files.
 '''
-import logging
+from collections import defaultdict
+from functools import wraps
 
-from django.db.models.signals import post_delete, post_init, post_save, pre_save
-from django.db.transaction import on_commit
+from django.db import router
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_init, post_save, pre_delete, pre_save)
 
-from . import cache
-from .signals import cleanup_post_delete, cleanup_pre_delete
-
-
-logger = logging.getLogger(__name__)
-
-
-class FakeInstance:
-    '''A Fake model instance to ensure an instance is not modified'''
+from . import cache, conf, deletion, metrics
+from .deletion import FakeInstance
+from .profiling import profiled
+from .references import index
 
 
+@profiled
 def cache_original_post_init(sender, instance, **kwargs):
     '''Post_init on all models with file fields, saves original values'''
+    if cache.is_readonly():
+        return
     cache.make_cleanup_cache(instance)
 
 
+@profiled
 def fallback_pre_save(sender, instance, raw, update_fields, using, **kwargs):
     '''Fallback to the database to remake the cleanup cache if there is none'''
     if raw:  # pragma: no cover
         return
 
     if instance.pk and not cache.has_cache(instance):
-        try:
-            db_instance = sender.objects.get(pk=instance.pk)
-        except sender.DoesNotExist:  # pragma: no cover
+        model_name = cache.get_plan(sender).model_name
+        if model_name in conf.get('NO_FALLBACK_MODELS'):
             return
-        cache.make_cleanup_cache(instance, source=db_instance)
+        backend = metrics.get_backend()
+        if backend is not None:
+            backend.increment('fallback_queries', tags={'model_name': model_name})
+        names = cache.fetch_original_names(sender, [instance.pk], using).get(instance.pk)
+        if names is not None:
+            cache.set_cleanup_cache(instance, names)
 
 
+@profiled
 def delete_old_post_save(sender, instance, raw, created, update_fields, using,
                          **kwargs):
     '''Post_save on all models with file fields, deletes old files'''
     if raw:
         return
 
-    if not created:
-        for field_name, new_file in cache.fields_for_model_instance(instance):
+    references = index.enabled()
+    changes = []
+    if created:
+        if references:
+            changes = [
+                (field_name, name, 1)
+                for field_name, name in cache.names_for_model_instance(instance)]
+    elif cache.has_cache(instance):
+        originals = cache.get_cache(instance)
+        stale = False
+        for field_name, new_name in cache.names_for_model_instance(instance):
+            if field_name not in originals:
+                # deferred when the cache was made and loaded since, the original name is unknown
+                stale = True
+                continue
+            old_name = originals[field_name]
+            if old_name == new_name:
+                continue
+            stale = True
             if update_fields is None or field_name in update_fields:
-                old_file = cache.get_field_attr(instance, field_name)
-                if old_file != new_file:
-                    delete_file(sender, instance, field_name, old_file, using, 'updated')
+                if references:
+                    changes += [(field_name, old_name, -1), (field_name, new_name, 1)]
+                old_file = cache.make_field_file(instance, field_name, old_name)
+                delete_file(sender, instance, field_name, old_file, using, 'updated')
+        if not stale:
+            # repeated saves without a file change keep the cache as it is
+            return
+    if changes:
+        track_references(sender, changes, using)
 
     # reset cache
     cache.make_cleanup_cache(instance)
 
 
-def delete_all_post_delete(sender, instance, using, **kwargs):
-    '''Post_delete on all models with file fields, deletes all files'''
-    for field_name, file_ in cache.fields_for_model_instance(instance):
-        delete_file(sender, instance, field_name, file_, using, 'deleted')
+@profiled
+def delete_all_post_delete(sender, instance, using, pk=None, **kwargs):
+    '''
+        Post_delete on all models with file fields, deletes all files. `pk` is passed when the
+        instance no longer has its pk.
+    '''
+    names = list(cache.names_for_model_instance(instance))
+    if index.enabled():
+        track_references(sender, [(field_name, name, -1) for field_name, name in names], using)
+    for field_name, name in names:
+        if name:
+            file_ = cache.make_field_file(instance, field_name, name)
+            delete_file(sender, instance, field_name, file_, using, 'deleted', pk)
+
+
+def fast_delete_method(delete):
+    '''
+        Wrap `Model.delete` of a model marked with `cleanup.fast_delete`, it has no post_delete
+        handler so the files of the instance are deleted here once the row is deleted
+    '''
+    @wraps(delete)
+    def delete_with_files(instance, using=None, keep_parents=False):
+        model = instance.__class__
+        if not cache.is_fast_delete(model) or not keep_fast_delete(model):
+            return delete(instance, using=using, keep_parents=keep_parents)
+        using = using or router.db_for_write(model, instance=instance)
+        pk = instance.pk
+        deleted = delete(instance, using=using, keep_parents=keep_parents)
+        delete_all_post_delete(model, instance, using, pk=pk)
+        return deleted
+    return delete_with_files
+
+
+def keep_fast_delete(model):
+    '''
+        Check that the ORM still fast deletes a model marked with `cleanup.fast_delete`. A
+        pre_delete, post_delete or m2m_changed receiver connected after the startup check makes it
+        load and delete the rows instead, so the model gets its post_delete handler from then on.
+    '''
+    if not any(signal.has_listeners(model) for signal in (pre_delete, post_delete, m2m_changed)):
+        return True
+    cache.FAST_DELETE_BLOCKED.add(model)
+    connect_post_delete(model)
+    return False
+
+
+def track_references(model, changes, using):
+    '''
+        Change the counts of the reference index, `changes` is a list of (field name, file name,
+        change in count). Default file names are not counted.
+    '''
+    model_name = cache.get_plan(model).model_name
+    deltas = defaultdict(int)
+    for field_name, name, delta in changes:
+        if name and name != cache.get_default_name(model, field_name):
+            deltas[(index.get_storage(model_name, field_name), name)] += delta
+    index.change(deltas, using)
+
+
+def delete_name(sender, field_name, name, using, reason, pk):
+    '''Deletes a file by name, for rows that were changed without a model instance'''
+    if not name:
+        return
+    field = cache.get_plan(sender).fields_by_name[field_name].field
+    file_ = field.attr_class(FakeInstance(), field, name)
+    delete_file(sender, None, field_name, file_, using, reason, pk)
 
 
-def delete_file(sender, instance, field_name, file_, using, reason):
-    '''Deletes a file'''
+@profiled
+def delete_file(sender, instance, field_name, file_, using, reason, pk=None):
+    '''Deletes a file, `instance` is None if the row was changed without one'''
 
     if not file_.name:
         return
@@ -71,53 +163,28 @@ def delete_file(sender, instance, field_name, file_, using, reason):
     # pickled filefields lose lots of data, and contrary to how it is
     # documented, the file descriptor does not recover them
 
-    model_name = cache.get_model_name(instance)
+    model = sender if instance is None else instance.__class__
+    plan = cache.get_plan(model)
+    model_name = plan.model_name
 
     # recover the 'field' if necessary
     if not hasattr(file_, 'field'):
-        file_.field = cache.get_field(model_name, field_name)()
-        file_.field.name = field_name
+        file_.field = cache.get_field(model_name, field_name)
 
     # if our file name is default don't delete
-    default = file_.field.default if not callable(file_.field.default) else file_.field.default()
+    default = cache.get_default_name(model, field_name)
 
     if file_.name == default:
         return
 
     # recover the 'storage' if necessary
     if not hasattr(file_, 'storage'):
-        file_.storage = cache.get_field_storage(model_name, field_name)()
-
-    event = {
-        'deleted': reason == 'deleted',
-        'model_name': model_name,
-        'field_name': field_name,
-        'file_name': file_.name,
-        'default_file_name': default,
-        'file': file_,
-        'instance': instance,
-        'updated': reason == 'updated'
-    }
-
-    # this will run after a successful commit
-    # assuming you are in a transaction and on a database that supports
-    # transactions, otherwise it will run immediately
-    def run_on_commit():
-        cleanup_pre_delete.send(sender=sender, **event)
-        success = False
-        error = None
-        try:
-            file_.delete(save=False)
-            success = True
-        except Exception as ex:
-            error = ex
-            opts = instance._meta
-            logger.exception(
-                'There was an exception deleting the file `%s` on field `%s.%s.%s`',
-                file_, opts.app_label, opts.model_name, field_name)
-        cleanup_post_delete.send(sender=sender, error=error, success=success, **event)
-
-    on_commit(run_on_commit, using)
+        file_.storage = cache.get_field_storage(model_name, field_name)
+
+    if pk is None:
+        pk = instance.pk
+    deletion.schedule(deletion.make_record(
+        file_.storage, file_.name, model_name, field_name, reason, pk, instance), using)
 
 
 def connect():
@@ -130,5 +197,62 @@ def connect():
                          dispatch_uid=f'pre_save{suffix}')
         post_save.connect(delete_old_post_save, sender=model,
                           dispatch_uid=f'post_save{suffix}')
-        post_delete.connect(delete_all_post_delete, sender=model,
-                            dispatch_uid=f'post_delete{suffix}')
+        connect_post_delete(model)
+
+
+def connect_post_delete(model):
+    '''
+        Connect post_delete to a cleanup model. Models marked with `cleanup.fast_delete` do not get
+        one, a post_delete receiver stops the ORM from deleting rows without loading them.
+    '''
+    if cache.is_fast_delete(model):
+        return
+    post_delete.connect(
+        delete_all_post_delete, sender=model,
+        dispatch_uid=f'post_delete_django_cleanup_{cache.get_model_name(model)}')
+
+
+def dispatcher(handler):
+    '''
+        Wrap a handler to receive the signal of every model, it returns early for models without
+        file fields with one dict lookup
+    '''
+    plans = cache.PLANS
+
+    def receiver(sender, **kwargs):
+        plan = plans.get(sender)
+        if plan is None:
+            plan = cache.get_plan(sender)
+        if plan.fields:
+            handler(sender, **kwargs)
+    receiver.__name__ = f'dispatch_{handler.__name__}'
+    return receiver
+
+
+# post_delete is connected per cleanup model, a post_delete receiver for all models would stop the
+# ORM from fast deleting any model
+DISPATCHERS = {
+    'post_init': (post_init, dispatcher(cache_original_post_init)),
+    'pre_save': (pre_save, dispatcher(fallback_pre_save)),
+    'post_save': (post_save, dispatcher(delete_old_post_save)),
+}
+
+
+def connect_dispatchers():
+    '''
+        Connect one receiver per signal for all models instead of four receivers per cleanup model,
+        see the CLEANUP_DISPATCH setting. In lazy mode models are prepared on their first signal.
+    '''
+    for name, (signal, receiver) in DISPATCHERS.items():
+        signal.connect(receiver, weak=False, dispatch_uid=f'{name}_django_cleanup')
+    # a model that is not prepared yet in lazy mode is fast deleted without a post_delete handler,
+    # only building its plan is deferred
+    models = cache.cleanup_models() if cache.STATE['complete'] else cache.file_field_models()
+    for model in models:
+        connect_post_delete(model)
+
+
+def disconnect_dispatchers():
+    '''Disconnect the receivers of `connect_dispatchers`'''
+    for name, (signal, _) in DISPATCHERS.items():
+        signal.disconnect(dispatch_uid=f'{name}_django_cleanup')
@@ -0,0 +1,37 @@
+'''Report the rows of the cleanup models whose files no longer exist'''
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_cleanup import dangling
+
+
+class Command(BaseCommand):
+    help = (
+        'Write a report of the rows of the cleanup models whose files no longer exist on their '
+        'storage. An interrupted run resumes from its checkpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'report', help='The json lines report, the checkpoint is written next to it.')
+        parser.add_argument('--database', help='The database to read the rows from.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000, help='Rows read from the database per query.')
+        parser.add_argument(
+            '--workers', type=int, default=8, help='Files checked on the storage in parallel.')
+        parser.add_argument(
+            '--cache-size', type=int, default=100000,
+            help='Checked names remembered, so names shared by rows are checked once.')
+        parser.add_argument(
+            '--restart', action='store_true', help='Ignore the checkpoint and start over.')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        state = dangling.check(
+            options['report'], using=options['database'], chunk_size=options['chunk_size'],
+            workers=options['workers'], cache_size=options['cache_size'],
+            restart=options['restart'])
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f"Checked {state['rows']} rows, {state['missing']} files missing "
+            f"in {elapsed:.2f}s.")
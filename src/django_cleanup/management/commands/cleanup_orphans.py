@@ -0,0 +1,87 @@
+'''Find and delete files on the storages of the cleanup models that no row references'''
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_cleanup import deletion, orphans
+
+
+class Command(BaseCommand):
+    help = (
+        'List the files on the storages of the cleanup models that no row references, '
+        'and delete them with --delete.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--delete', action='store_true',
+            help='Delete the orphaned files, without it this is a dry run.')
+        parser.add_argument(
+            '--field', action='append', default=[],
+            help='Only scan the storage of this app_label.model_name.field_name, repeatable.')
+        parser.add_argument('--prefix', default='', help='Only scan files under this path.')
+        parser.add_argument(
+            '--exclude', action='append', default=[],
+            help='Skip files matching this glob, repeatable.')
+        parser.add_argument(
+            '--min-age', type=float, default=86400,
+            help='Skip files modified less than this many seconds ago, 0 to disable.')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Directories under the prefix listed in parallel.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000, help='Rows read from the database per query.')
+        parser.add_argument(
+            '--run-size', type=int, default=1000000, help='Names sorted in memory at a time.')
+        parser.add_argument('--tmp-dir', help='Where the sorted runs are written.')
+        parser.add_argument('--output', help='Write the orphaned names to this file.')
+
+    def handle(self, *args, **options):
+        storages = orphans.get_storages()
+        if options['field']:
+            storages = [
+                (storage, fields) for storage, fields in storages
+                if set(fields).intersection(options['field'])]
+            if not storages:
+                raise CommandError('None of the fields are file fields of cleanup models.')
+
+        output = open(options['output'], 'w', encoding='utf-8') if options['output'] else None
+        found = deleted = 0
+        try:
+            with tempfile.TemporaryDirectory(dir=options['tmp_dir']) as directory:
+                referenced_path, count = orphans.write_referenced(
+                    directory, options['chunk_size'], options['run_size'])
+                self.stdout.write(f'Read {count} referenced names.')
+                deleter = deletion.get_deleter()
+                for storage, fields in storages:
+                    self.stdout.write(f"Scanning the storage of {', '.join(fields)}.")
+                    chunk = []
+                    for name in orphans.find_orphans(
+                            storage, referenced_path, directory, prefix=options['prefix'],
+                            workers=options['workers'], run_size=options['run_size'],
+                            exclude=options['exclude'], min_age=options['min_age']):
+                        found += 1
+                        if output is not None:
+                            output.write(f'{name}\n')
+                        elif options['verbosity'] >= 1:
+                            self.stdout.write(name)
+                        if options['delete']:
+                            chunk.append(name)
+                            if len(chunk) >= deleter.chunk_size:
+                                deleted += self.delete(deleter, storage, chunk)
+                                chunk = []
+                    if chunk:
+                        deleted += self.delete(deleter, storage, chunk)
+        finally:
+            if output is not None:
+                output.close()
+
+        if options['delete']:
+            self.stdout.write(f'Found {found} orphaned files, deleted {deleted}.')
+        else:
+            self.stdout.write(f'Found {found} orphaned files, dry run, nothing was deleted.')
+
+    def delete(self, deleter, storage, names):
+        errors = deleter.delete(storage, names)
+        for name, error in errors.items():
+            self.stderr.write(f'Could not delete {name}: {error}')
+        return len(names) - len(errors)
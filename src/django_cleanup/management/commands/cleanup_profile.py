@@ -0,0 +1,29 @@
+'''Profile the post_init handler of the cleanup models on rows of the database'''
+from django.core.management.base import BaseCommand
+
+from django_cleanup import cache, cleanup
+
+
+class Command(BaseCommand):
+    help = (
+        'Load rows of each cleanup model with profiling enabled and print the time spent in the '
+        'cleanup handlers per model, most time first. Nothing is saved or deleted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, default=1000, help='Rows loaded per model.')
+        parser.add_argument('--database', help='The database to load the rows from.')
+
+    def handle(self, *args, **options):
+        with cleanup.profile() as profile:
+            for model in cache.cleanup_models():
+                queryset = model._base_manager.using(options['database'])[:options['rows']]
+                for _ in queryset.iterator(chunk_size=2000):
+                    pass
+
+        self.stdout.write(
+            f"{'handler':<26}{'model':<40}{'calls':>10}{'total ms':>12}{'us/call':>10}")
+        for entry in profile.report():
+            self.stdout.write(
+                f'{entry.handler:<26}{entry.model_name:<40}{entry.calls:>10}'
+                f'{entry.seconds * 1e3:>12.2f}{entry.seconds_per_call * 1e6:>10.2f}')
@@ -0,0 +1,20 @@
+'''Rebuild the reference index of django_cleanup.references'''
+from django.core.management.base import BaseCommand, CommandError
+
+from django_cleanup.references import index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the reference index from the file fields of all cleanup models.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', help='The database to rebuild the index on.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000, help='Rows read and written per query.')
+
+    def handle(self, *args, **options):
+        if not index.enabled():
+            raise CommandError(
+                'Add django_cleanup.references.apps.ReferencesConfig to INSTALLED_APPS.')
+        count = index.rebuild(using=options['database'], chunk_size=options['chunk_size'])
+        self.stdout.write(f'Indexed {count} files.')
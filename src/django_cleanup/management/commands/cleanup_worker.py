@@ -0,0 +1,51 @@
+'''Drain the deletion spool directory set with the CLEANUP_QUEUE_PATH setting'''
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_cleanup import conf, spool
+
+
+class Command(BaseCommand):
+    help = 'Delete the files queued in the CLEANUP_QUEUE_PATH spool directory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', help='The spool directory, defaults to the CLEANUP_QUEUE_PATH setting.')
+        parser.add_argument(
+            '--once', action='store_true', help='Exit once the spool has been drained.')
+        parser.add_argument(
+            '--sleep', type=float, default=5,
+            help='Seconds to wait between polls of an empty spool.')
+        parser.add_argument(
+            '--batch-size', type=int, help='Files per storage call, defaults to the deleter.')
+        parser.add_argument(
+            '--max-attempts', type=int, default=5,
+            help='Attempts before a deletion is moved to the failed directory.')
+        parser.add_argument(
+            '--backoff', type=float, default=30,
+            help='Seconds before the first retry, doubled for each further attempt.')
+        parser.add_argument(
+            '--rate', type=float, help='The max number of files deleted per second.')
+
+    def handle(self, *args, **options):
+        path = options['path'] or conf.get('QUEUE_PATH')
+        if not path:
+            raise CommandError('Set the CLEANUP_QUEUE_PATH setting or pass --path.')
+
+        while True:
+            start = time.monotonic()
+            stats = spool.drain(
+                path, batch_size=options['batch_size'], max_attempts=options['max_attempts'],
+                backoff=options['backoff'], rate=options['rate'])
+            elapsed = time.monotonic() - start
+            processed = stats['deleted'] + stats['failed'] + stats['retried']
+            if processed or options['once']:
+                self.stdout.write(
+                    f"Deleted {stats['deleted']} files, {stats['failed']} failed, "
+                    f"{stats['retried']} to retry, {stats['deferred']} deferred "
+                    f"in {elapsed:.2f}s ({processed / elapsed if elapsed else 0:.1f} files/s)")
+            if options['once']:
+                return
+            if not processed:
+                time.sleep(options['sleep'])
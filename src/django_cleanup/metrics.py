@@ -0,0 +1,131 @@
+'''
+    Optional metrics of the handlers and of file deletions, sent to the backend set with the
+    CLEANUP_METRICS_BACKEND setting. Nothing is measured when it is not set.
+
+    Metrics, tagged with `model_name` and, for deletions, `field_name`:
+    - `snapshots`: cleanup caches made for instances
+    - `fallback_queries`: queries made by the pre_save fallback
+    - `deletions_queued`: files queued for deletion
+    - `deletions_succeeded` and `deletions_failed`: files deleted on the storage or not
+    - `delete_seconds`: histogram of the time to delete a file, the time of a chunk of files is
+      split evenly over its files
+'''
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from . import conf
+
+
+# the backend made from the setting, remade when the setting changes
+STATE = {'loaded': False, 'backend': None}
+
+
+def get_backend():
+    '''Get the configured backend, None when metrics are disabled'''
+    if not STATE['loaded']:
+        path = conf.get('METRICS_BACKEND')
+        STATE['backend'] = import_string(path)() if path else None
+        STATE['loaded'] = True
+    return STATE['backend']
+
+
+def reset_backend(setting, **kwargs):
+    if setting == 'CLEANUP_METRICS_BACKEND':
+        STATE['loaded'] = False
+setting_changed.connect(reset_backend, dispatch_uid='django_cleanup_metrics')
+
+
+def deletions_done(backend, files, errors, elapsed):
+    '''
+        Record a deleted chunk, `files` is a list of (file name, model name, field name) and
+        `errors` a dict of file name to error
+    '''
+    seconds = elapsed / len(files) if files else 0
+    for file_name, model_name, field_name in files:
+        tags = {'model_name': model_name, 'field_name': field_name}
+        backend.increment(
+            'deletions_failed' if errors.get(file_name) is not None else 'deletions_succeeded',
+            tags=tags)
+        backend.observe('delete_seconds', seconds, tags=tags)
+
+
+class MetricsBackend:
+    '''The interface of a metrics backend, e.g. an adapter to a StatsD or Prometheus client'''
+
+    def increment(self, name, value=1, tags=None):
+        '''Add to a counter'''
+        raise NotImplementedError
+
+    def observe(self, name, value, tags=None):
+        '''Add a value to a histogram'''
+        raise NotImplementedError
+
+
+class Histogram:
+    '''A histogram with cumulative buckets, like a Prometheus histogram'''
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def buckets(self):
+        '''A dict of upper bound to the number of values less than or equal to it'''
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets[bound] = total
+        return buckets
+
+
+class InMemoryBackend(MetricsBackend):
+    '''Keeps the metrics in memory, e.g. for tests or to expose them from a view'''
+
+    bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.histograms = {}
+
+    @staticmethod
+    def make_key(name, tags):
+        return name, tuple(sorted(tags.items())) if tags else ()
+
+    def increment(self, name, value=1, tags=None):
+        key = self.make_key(name, tags)
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, tags=None):
+        key = self.make_key(name, tags)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.bounds)
+            histogram.observe(value)
+
+    def get(self, name, **tags):
+        '''Get the value of a counter'''
+        return self.counters[self.make_key(name, tags)]
+
+    def get_histogram(self, name, **tags):
+        '''Get a histogram, None if nothing was observed'''
+        return self.histograms.get(self.make_key(name, tags))
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
@@ -0,0 +1,183 @@
+'''
+    Find files on the storages of the cleanup models that no row references. Both the referenced
+    names and the storage listings are streamed through external sorts on disk, so memory stays
+    bounded however many files there are, then the two sorted streams are merged.
+'''
+import fnmatch
+import heapq
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import groupby
+
+from django.apps import apps
+from django.db import models
+from django.utils import timezone
+
+from . import cache
+
+
+def encode(name):
+    '''Encode a name on a single line, the same encoding is used on both sides of the merge'''
+    return name.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def decode(line):
+    return line.replace('\\n', '\n').replace('\\\\', '\\')
+
+
+class ExternalSort:
+    '''Sorts lines with at most `run_size` lines in memory, sorted runs spill to `directory`'''
+
+    def __init__(self, directory, run_size=1000000):
+        self.directory = directory
+        self.run_size = run_size
+        self.lines = []
+        self.runs = []
+
+    def add(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        if not self.lines:
+            return
+        self.lines.sort()
+        with tempfile.NamedTemporaryFile(
+                'w', dir=self.directory, suffix='.run', delete=False, encoding='utf-8',
+                newline='\n') as run:
+            for line in self.lines:
+                run.write(line)
+                run.write('\n')
+        self.runs.append(run.name)
+        self.lines = []
+
+    @staticmethod
+    def merge(sorters):
+        '''Yields the unique lines of all the sorters in order'''
+        for sorter in sorters:
+            sorter.spill()
+        # a '\r' in a name is not a line break
+        files = [
+            open(run, encoding='utf-8', newline='\n') for sorter in sorters for run in sorter.runs]
+        try:
+            merged = heapq.merge(*((line.rstrip('\n') for line in file_) for file_ in files))
+            for line, _ in groupby(merged):
+                yield line
+        finally:
+            for file_ in files:
+                file_.close()
+
+
+def get_storage_key(storage):
+    '''Storages made with the same arguments are the same storage, e.g. from a callable storage'''
+    try:
+        path, args, kwargs = storage.deconstruct()
+    except AttributeError:
+        return id(storage)
+    return (path, repr(args), repr(sorted(kwargs.items())))
+
+
+def get_storages():
+    '''Get the distinct storages of the cleanup models, with the fields that use them'''
+    storages = {}
+    for model in cache.cleanup_models():
+        plan = cache.get_plan(model)
+        for field in plan.fields:
+            storages.setdefault(get_storage_key(field.storage), (field.storage, []))[1].append(
+                f'{plan.model_name}.{field.name}')
+    return list(storages.values())
+
+
+def iter_referenced_names(chunk_size=2000):
+    '''
+        Yields every file name stored in a file field and every default file name. All models are
+        read, not only the cleanup models, a file of an ignored model is still referenced. Names
+        are read with chunked `values_list` queries, no model instances are made.
+    '''
+    fields = [
+        (model, field) for model in apps.get_models() for field in model._meta.concrete_fields
+        if isinstance(field, models.FileField)]
+    for _, field in fields:
+        default = field.default() if callable(field.default) else field.default
+        if isinstance(default, str) and default:
+            yield default
+    for model, field in cache.unique_columns(fields):
+        names = model._base_manager.exclude(**{f'{field.attname}__isnull': True}).exclude(
+            **{field.attname: ''}).values_list(field.attname, flat=True)
+        yield from names.iterator(chunk_size=chunk_size)
+
+
+def walk(storage, path=''):
+    '''Yields the names of all files on a storage under `path`'''
+    directories, files = storage.listdir(path)
+    for file_ in files:
+        yield f'{path}/{file_}' if path else file_
+    for directory in directories:
+        yield from walk(storage, f'{path}/{directory}' if path else directory)
+
+
+def list_storage(storage, directory, prefix='', workers=1, run_size=1000000):
+    '''
+        Sort the names of all files on a storage under `prefix`. With more than one worker each
+        directory directly under the prefix is listed in parallel into its own sort.
+    '''
+    prefix = prefix.strip('/')
+    directories, files = storage.listdir(prefix)
+    join = (lambda name: f'{prefix}/{name}') if prefix else (lambda name: name)
+
+    def sort_directory(name):
+        sorter = ExternalSort(directory, run_size)
+        for file_name in walk(storage, join(name)):
+            sorter.add(encode(file_name))
+        sorter.spill()
+        return sorter
+
+    top = ExternalSort(directory, run_size)
+    for file_ in files:
+        top.add(encode(join(file_)))
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        sorters = list(executor.map(sort_directory, directories))
+    return ExternalSort.merge([top] + sorters)
+
+
+def find_orphans(storage, referenced_path, directory, prefix='', workers=1, run_size=1000000,
+                 exclude=(), min_age=None):
+    '''
+        Yields the names on a storage that are not in the sorted file of referenced names.
+        Names matching an `exclude` glob, or modified less than `min_age` seconds ago, are skipped.
+    '''
+    cutoff = timezone.now() - timedelta(seconds=min_age) if min_age else None
+    with open(referenced_path, encoding='utf-8', newline='\n') as referenced_file:
+        referenced = (line.rstrip('\n') for line in referenced_file)
+        current = next(referenced, None)
+        for line in list_storage(storage, directory, prefix, workers, run_size):
+            while current is not None and current < line:
+                current = next(referenced, None)
+            if line == current:
+                continue
+            name = decode(line)
+            if any(fnmatch.fnmatch(name, pattern) for pattern in exclude):
+                continue
+            if cutoff is not None and storage.get_modified_time(name) > cutoff:
+                continue
+            yield name
+
+
+def write_referenced(directory, chunk_size=2000, run_size=1000000):
+    '''Write the sorted unique referenced names to a file in `directory`, returns its path'''
+    sorter = ExternalSort(directory, run_size)
+    count = 0
+    for name in iter_referenced_names(chunk_size):
+        sorter.add(encode(name))
+        count += 1
+    path = os.path.join(directory, 'referenced.txt')
+    with open(path, 'w', encoding='utf-8', newline='\n') as file_:
+        for line in ExternalSort.merge([sorter]):
+            file_.write(line)
+            file_.write('\n')
+    for run in sorter.runs:
+        os.remove(run)
+    return path, count
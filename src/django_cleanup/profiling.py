@@ -0,0 +1,93 @@
+'''
+    Profiling of the signal handlers, the cumulative time spent in each handler per model. Enabled
+    with the CLEANUP_PROFILE setting or the `cleanup.profile` context manager.
+'''
+import threading
+import time
+from collections import namedtuple
+from contextvars import ContextVar
+from functools import wraps
+
+from django.core.signals import setting_changed
+
+from . import conf
+
+
+ProfileEntry = namedtuple(
+    'ProfileEntry', ['handler', 'model_name', 'calls', 'seconds', 'seconds_per_call'])
+
+
+class Profile:
+    '''The calls and cumulative time of each handler per model class'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (handler name, model class) -> [calls, seconds]
+        self.times = {}
+
+    def add(self, handler, model, seconds):
+        with self.lock:
+            times = self.times.get((handler, model))
+            if times is None:
+                times = self.times[(handler, model)] = [0, 0]
+            times[0] += 1
+            times[1] += seconds
+
+    def report(self):
+        '''
+            Get a list of `ProfileEntry`, most time first. Times are inclusive, the time of
+            `delete_file` is also in the time of the handler that called it.
+        '''
+        with self.lock:
+            times = list(self.times.items())
+        entries = [
+            ProfileEntry(
+                handler, f'{model._meta.app_label}.{model._meta.model_name}', calls, seconds,
+                seconds / calls)
+            for (handler, model), (calls, seconds) in times]
+        return sorted(entries, key=lambda entry: entry.seconds, reverse=True)
+
+    def clear(self):
+        with self.lock:
+            self.times.clear()
+
+
+# the profile of the `cleanup.profile` context
+PROFILE = ContextVar('django_cleanup_profile', default=None)
+# the profile used with the CLEANUP_PROFILE setting, the setting is read once until it changes
+STATE = {'loaded': False, 'enabled': False}
+SETTING_PROFILE = Profile()
+
+
+def get_profile():
+    '''Get the profile handler times are added to, None when not profiling'''
+    profile = PROFILE.get()
+    if profile is not None:
+        return profile
+    if not STATE['loaded']:
+        STATE['enabled'] = conf.get('PROFILE')
+        STATE['loaded'] = True
+    return SETTING_PROFILE if STATE['enabled'] else None
+
+
+def reset_setting(setting, **kwargs):
+    if setting == 'CLEANUP_PROFILE':
+        STATE['loaded'] = False
+setting_changed.connect(reset_setting, dispatch_uid='django_cleanup_profiling')
+
+
+def profiled(handler):
+    '''Add the time of each call of a handler to the profile, the first argument is the model'''
+    name = handler.__name__
+
+    @wraps(handler)
+    def wrapper(sender, *args, **kwargs):
+        profile = get_profile()
+        if profile is None:
+            return handler(sender, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return handler(sender, *args, **kwargs)
+        finally:
+            profile.add(name, sender, time.perf_counter() - start)
+    return wrapper
@@ -0,0 +1,167 @@
+'''QuerySet support for cleanup models'''
+from django.db import connections, transaction
+from django.db.models.query import ModelIterable, QuerySet
+
+from . import cache, handlers
+from .references import index
+
+
+__all__ = ['CleanupQuerySetMixin', 'CleanupQuerySet']
+
+
+class ReadonlyModelIterable(ModelIterable):
+    '''Yields instances that are made without a cleanup cache'''
+
+    def __iter__(self):
+        iterator = super().__iter__()
+        while True:
+            # only the instance creation is readonly, not the code consuming the rows, the context
+            # variable is set directly as a context manager per row costs as much as the cache
+            token = cache.READONLY.set(True)
+            try:
+                instance = next(iterator, None)
+            finally:
+                cache.READONLY.reset(token)
+            if instance is None:
+                return
+            yield instance
+
+
+class CleanupQuerySetMixin:
+    '''
+        Mixin for a QuerySet of a model with file fields.
+
+        `update()` and `bulk_update()` do not send signals, so the mixin reads the old file names
+        of the changed rows and deletes the files that changed when the transaction commits.
+    '''
+
+    # set on the querysets of a `bulk_update()` so the update of each batch is not read again
+    _cleanup_bulk_update = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._cleanup_bulk_update = self._cleanup_bulk_update
+        return clone
+
+    def _for_old_names(self):
+        '''
+            Lock the rows whose old names are read until the update, where the database can. The
+            rows are locked through a pk subquery, FOR UPDATE is not allowed with every filter.
+        '''
+        features = connections[self.db].features
+        if not features.has_select_for_update or self.query.group_by is not None:
+            return self
+        kwargs = {'of': ('self',)} if features.has_select_for_update_of else {}
+        return self.model._base_manager.db_manager(self.db).filter(
+            pk__in=self.values('pk')).select_for_update(**kwargs)
+
+    def _fetch_all(self):
+        if self._result_cache is None and cache.is_fast_delete(self.model):
+            # the ORM loads the rows of a model it can no longer fast delete
+            handlers.keep_fast_delete(self.model)
+        super()._fetch_all()
+
+    def without_cleanup(self):
+        '''Load instances without a cleanup cache, for querysets that are only read'''
+        clone = self._chain()
+        if clone._iterable_class is ModelIterable:
+            clone._iterable_class = ReadonlyModelIterable
+        return clone
+
+    def update(self, **kwargs):
+        fields = [
+            field for field in cache.get_plan(self.model).fields
+            if field.name in kwargs or field.attname in kwargs]
+        if not fields or self._cleanup_bulk_update:
+            return super().update(**kwargs)
+
+        names = [field.name for field in fields]
+        attnames = [field.attname for field in fields]
+        # read the old names from the database that is written to
+        self._for_write = True
+        with transaction.atomic(using=self.db, savepoint=False):
+            old_rows = list(self._for_old_names().values_list('pk', *attnames))
+            rows = super().update(**kwargs)
+            new_values = [kwargs.get(field.name, kwargs.get(field.attname)) for field in fields]
+            if any(hasattr(value, 'resolve_expression') for value in new_values):
+                # expressions are only known once the database has evaluated them
+                new_rows = {
+                    pk: [row[name] for name in names]
+                    for pk, row in cache.fetch_original_names(
+                        self.model, [row[0] for row in old_rows], using=self.db).items()}
+            else:
+                new_names = [cache.get_file_name(value) for value in new_values]
+                new_rows = dict.fromkeys((row[0] for row in old_rows), new_names)
+            for pk, *old_names in old_rows:
+                self._delete_changed(names, pk, old_names, new_rows.get(pk, old_names))
+        return rows
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        objs = tuple(objs)
+        file_fields = [field for field in cache.get_plan(self.model).fields if field.name in fields]
+        if not file_fields or not objs or self._cleanup_bulk_update:
+            return super().bulk_update(objs, fields, batch_size=batch_size)
+
+        names = [field.name for field in file_fields]
+        attnames = [field.attname for field in file_fields]
+        self._for_write = True
+        with transaction.atomic(using=self.db, savepoint=False):
+            # the old names of the rows the filters of the queryset let through
+            pks = [obj.pk for obj in objs]
+            size = max(connections[self.db].ops.bulk_batch_size(['pk'], pks), 1)
+            originals = {}
+            for start in range(0, len(pks), size):
+                rows = self._for_old_names().filter(
+                    pk__in=pks[start:start + size]).values_list('pk', *attnames)
+                originals.update((pk, old_names) for pk, *old_names in rows)
+            queryset = self._chain()
+            queryset._cleanup_bulk_update = True
+            rows = queryset.bulk_update(objs, fields, batch_size=batch_size)
+            for obj in objs:
+                old_names = originals.get(obj.pk)
+                if old_names is None:
+                    continue
+                new_names = [cache.get_file_name(obj.__dict__.get(name)) for name in names]
+                self._delete_changed(names, obj.pk, old_names, new_names)
+                if cache.has_cache(obj):
+                    # the old files are gone, a later save must not see them as original
+                    snapshot = dict(cache.get_cache(obj).items())
+                    snapshot.update(zip(names, new_names))
+                    cache.set_cleanup_cache(obj, snapshot)
+        return rows
+
+    def _raw_delete(self, using):
+        '''
+            The ORM deletes rows with `_raw_delete` without loading them when it can fast delete a
+            queryset or a cascade. For models marked with `cleanup.fast_delete` only the pk and the
+            file names of the rows are read first, and their files are deleted on commit.
+        '''
+        fields = cache.get_plan(self.model).fields
+        if not fields or not cache.is_fast_delete(self.model):
+            return super()._raw_delete(using)
+
+        names = [field.name for field in fields]
+        rows = list(self.using(using).values_list('pk', *(field.attname for field in fields)))
+        count = super()._raw_delete(using)
+        changes = []
+        for pk, *file_names in rows:
+            for field_name, name in zip(names, file_names):
+                changes.append((field_name, name, -1))
+                handlers.delete_name(self.model, field_name, name, using, 'deleted', pk)
+        if changes and index.enabled():
+            handlers.track_references(self.model, changes, using)
+        return count
+
+    def _delete_changed(self, names, pk, old_names, new_names):
+        '''Delete the old files of a row that were replaced'''
+        changes = []
+        for field_name, old_name, new_name in zip(names, old_names, new_names):
+            if old_name != new_name:
+                changes += [(field_name, old_name, -1), (field_name, new_name, 1)]
+                handlers.delete_name(self.model, field_name, old_name, self.db, 'updated', pk)
+        if changes and index.enabled():
+            handlers.track_references(self.model, changes, self.db)
+
+
+class CleanupQuerySet(CleanupQuerySetMixin, QuerySet):
+    pass
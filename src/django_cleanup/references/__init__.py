@@ -0,0 +1,5 @@
+'''
+    An optional index of how many rows reference each file, add
+    `django_cleanup.references.apps.ReferencesConfig` to `INSTALLED_APPS` to use it. Files that are
+    still referenced by another row are not deleted.
+'''
@@ -0,0 +1,16 @@
+'''
+    AppConfig for the reference index, enables the index when installed
+'''
+from django.apps import AppConfig
+
+from . import index
+
+
+class ReferencesConfig(AppConfig):
+    name = 'django_cleanup.references'
+    label = 'django_cleanup_references'
+    verbose_name = 'Django Cleanup References'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        index.STATE['enabled'] = True
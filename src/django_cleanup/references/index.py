@@ -0,0 +1,102 @@
+'''
+    Maintain the reference index. The counts are changed in the transaction of the save or delete
+    that changed them, so a rollback also rolls back the counts.
+'''
+import hashlib
+from collections import defaultdict
+
+from django.apps import apps
+from django.db import connections, router, transaction
+from django.db.models import F
+
+from .. import cache
+
+
+STATE = {'enabled': False}
+
+
+def enabled():
+    '''Check if the reference index is installed'''
+    return STATE['enabled']
+
+
+def get_model():
+    return apps.get_model('django_cleanup_references', 'FileReference')
+
+
+def make_key(storage, name):
+    '''The key of a file name on a storage, storage is the dotted path of the storage class'''
+    return hashlib.sha256(f'{storage}\0{name}'.encode()).hexdigest()
+
+
+def get_storage(model_name, field_name):
+    '''The storage part of the key of a field'''
+    return cache.FIELDS_STORAGE[model_name][field_name]
+
+
+def change(deltas, using=None):
+    '''
+        Apply reference count changes, `deltas` is a dict of (storage, name) to the change in count.
+        Rows that are no longer referenced are removed.
+    '''
+    deltas = {file_: delta for file_, delta in deltas.items() if file_[1] and delta}
+    if not deltas:
+        return
+    model = get_model()
+    using = using or router.db_for_write(model)
+    manager = model._base_manager.using(using)
+    keys = {file_: make_key(*file_) for file_ in deltas}
+    by_delta = defaultdict(list)
+    for file_, delta in deltas.items():
+        by_delta[delta].append(keys[file_])
+
+    with transaction.atomic(using=using, savepoint=False):
+        added = [file_ for file_, delta in deltas.items() if delta > 0]
+        if added:
+            manager.bulk_create([
+                model(key=keys[file_], storage=file_[0], name=file_[1], count=0)
+                for file_ in added], ignore_conflicts=True)
+        for delta, delta_keys in by_delta.items():
+            manager.filter(key__in=delta_keys).update(count=F('count') + delta)
+        if len(added) != len(deltas):
+            manager.filter(key__in=keys.values(), count__lte=0).delete()
+
+
+def referenced(storage, names, using=None):
+    '''Get the names on a storage that are still referenced'''
+    model = get_model()
+    using = using or router.db_for_read(model)
+    keys = {make_key(storage, name): name for name in names}
+    key_list = list(keys)
+    batch_size = max(connections[using].ops.bulk_batch_size(['key'], key_list), 1)
+    found = set()
+    for start in range(0, len(key_list), batch_size):
+        found.update(model._base_manager.using(using).filter(
+            key__in=key_list[start:start + batch_size], count__gt=0).values_list('key', flat=True))
+    return {keys[key] for key in found}
+
+
+def rebuild(using=None, chunk_size=2000):
+    '''Rebuild the index from the file fields of all cleanup models, returns the number of files'''
+    model = get_model()
+    counts = defaultdict(int)
+    fields = cache.unique_columns(
+        (cleanup_model, field.field) for cleanup_model in cache.cleanup_models()
+        for field in cache.get_plan(cleanup_model).fields)
+    for cleanup_model, field in fields:
+        storage = get_storage(cache.get_model_name(cleanup_model), field.name)
+        default = cache.get_default_name(cleanup_model, field.name)
+        names = cleanup_model._base_manager.using(using).exclude(
+            **{f'{field.attname}__isnull': True}).exclude(
+            **{field.attname: ''}).values_list(field.attname, flat=True)
+        for name in names.iterator(chunk_size=chunk_size):
+            if name != default:
+                counts[(storage, name)] += 1
+
+    using = using or router.db_for_write(model)
+    with transaction.atomic(using=using):
+        model._base_manager.using(using).all().delete()
+        model._base_manager.using(using).bulk_create((
+            model(key=make_key(*file_), storage=file_[0], name=file_[1], count=count)
+            for file_, count in counts.items()), batch_size=chunk_size)
+    return len(counts)
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name='FileReference',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('storage', models.CharField(max_length=255)),
+                ('name', models.TextField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
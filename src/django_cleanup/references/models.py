@@ -0,0 +1,13 @@
+from django.db import models
+
+
+class FileReference(models.Model):
+    '''The number of rows referencing a file name on a storage'''
+    # sha256 of the storage and the name, names can be longer than an index allows
+    key = models.CharField(max_length=64, primary_key=True)
+    storage = models.CharField(max_length=255)
+    name = models.TextField()
+    count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.storage}:{self.name} ({self.count})'
@@ -4,7 +4,9 @@
 from django.dispatch import Signal
 
 
-__all__ = ['cleanup_pre_delete', 'cleanup_post_delete']
+__all__ = [
+    'cleanup_pre_delete', 'cleanup_post_delete', 'cleanup_pre_delete_batch',
+    'cleanup_post_delete_batch']
 
 
 cleanup_pre_delete = Signal()
@@ -13,3 +15,18 @@ cleanup_pre_delete = Signal()
 
 cleanup_post_delete = Signal()
 '''Called just after a file is deleted. Passes a `file` keyword argument.'''
+
+
+cleanup_pre_delete_batch = Signal()
+'''
+    Called just before the files of a storage are deleted when a transaction commits. The sender is
+    the storage class. Passes `storage` and `events` keyword arguments, `events` is a list of the
+    keyword arguments of `cleanup_pre_delete` for each file.
+'''
+
+
+cleanup_post_delete_batch = Signal()
+'''
+    Called once all the files of a storage are deleted when a transaction commits. Passes `storage`
+    and `events` keyword arguments, each event also has the `error` and `success` of the file.
+'''
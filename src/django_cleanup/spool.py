@@ -0,0 +1,220 @@
+'''
+    A spool directory of pending deletions. When the `CLEANUP_QUEUE_PATH` setting is set, committed
+    batches are written to the spool instead of being deleted, and the `cleanup_worker` management
+    command drains it. Every batch is written to its own file and a worker claims a file by
+    renaming it, so writers and workers never share a file.
+'''
+import json
+import logging
+import os
+import time
+import uuid
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.utils.module_loading import import_string
+
+from . import cache, deletion, metrics
+from .signals import (
+    cleanup_post_delete, cleanup_post_delete_batch, cleanup_pre_delete, cleanup_pre_delete_batch)
+
+
+logger = logging.getLogger(__name__)
+
+FAILED_DIR = 'failed'
+
+
+def make_record(record):
+    '''Make the spool record of a `DeletionRecord`'''
+    return {
+        'storage': cache.FIELDS_STORAGE[record.model_name][record.field_name],
+        'model': record.model_name,
+        'field': record.field_name,
+        'name': record.file_name,
+        'reason': record.reason,
+        'pk': record.pk,
+        'attempts': 0,
+        'retry_at': 0
+    }
+
+
+def write(path, records):
+    '''Write records to a new spool file, the file only appears once it is complete'''
+    if not records:
+        return
+    os.makedirs(path, exist_ok=True)
+    name = os.path.join(path, f'{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex}.jsonl')
+    with open(f'{name}.tmp', 'w', encoding='utf-8') as file_:
+        for record in records:
+            file_.write(json.dumps(record, default=str))
+            file_.write('\n')
+    os.replace(f'{name}.tmp', name)
+
+
+def read(path):
+    '''Read the records of a spool file'''
+    with open(path, encoding='utf-8') as file_:
+        return [json.loads(line) for line in file_ if line.strip()]
+
+
+def claim(path, stale=3600):
+    '''
+        Yields the spool files claimed by this worker. Files claimed by a worker that did not
+        finish within `stale` seconds are claimed again.
+    '''
+    try:
+        entries = sorted(os.listdir(path))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        source = os.path.join(path, entry)
+        if entry.endswith('.jsonl'):
+            target = f'{source}.work'
+        elif entry.endswith('.work'):
+            try:
+                if time.time() - os.path.getmtime(source) < stale:
+                    continue
+            except FileNotFoundError:
+                continue
+            target = source
+        else:
+            continue
+        try:
+            os.replace(source, target)
+            os.utime(target)
+        except FileNotFoundError:
+            # claimed by another worker
+            continue
+        yield target
+
+
+def get_target(record):
+    '''Get the sender, field and storage of a record, the field is None if it no longer exists'''
+    try:
+        model = apps.get_model(record['model'])
+        field = model._meta.get_field(record['field'])
+    except (LookupError, FieldDoesNotExist):
+        return None, None, import_string(record['storage'])()
+    return model, field, field.storage
+
+
+def make_event(model, field, record):
+    '''Make the cleanup signal kwargs of a record, the instance is gone and is passed as None'''
+    return {
+        'deleted': record['reason'] == 'deleted',
+        'model_name': record['model'],
+        'field_name': record['field'],
+        'file_name': record['name'],
+        'default_file_name': cache.get_default_name(model, field.name),
+        'file': field.attr_class(deletion.FakeInstance(), field, record['name']),
+        'instance': None,
+        'updated': record['reason'] == 'updated'
+    }
+
+
+class RateLimiter:
+    '''Sleeps to keep the deletions under `rate` files per second, no limit if rate is falsy'''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.count = 0
+        self.start = time.monotonic()
+
+    def __call__(self, count):
+        self.count += count
+        if self.rate:
+            wait = self.count / self.rate - (time.monotonic() - self.start)
+            if wait > 0:
+                time.sleep(wait)
+
+
+def drain(path, batch_size=None, max_attempts=5, backoff=30, rate=None, stale=3600):
+    '''
+        Delete the files in the spool, returns a dict of counts.
+
+        Failed deletions are retried with an exponential backoff of `backoff` seconds, after
+        `max_attempts` they are moved to the `failed` directory of the spool.
+    '''
+    deleter = deletion.get_deleter()
+    batch_size = batch_size or deleter.chunk_size
+    limiter = RateLimiter(rate)
+    stats = {'deleted': 0, 'failed': 0, 'retried': 0, 'deferred': 0}
+    for work_path in claim(path, stale):
+        now = time.time()
+        retry = []
+        failed = []
+        groups = {}
+        for record in read(work_path):
+            if record['retry_at'] > now:
+                retry.append(record)
+                stats['deferred'] += 1
+            else:
+                groups.setdefault((record['model'], record['field'], record['storage']), []).append(
+                    record)
+
+        for records in groups.values():
+            model, field, storage = get_target(records[0])
+            for start in range(0, len(records), batch_size):
+                chunk = records[start:start + batch_size]
+                errors = delete_records(deleter, model, field, storage, chunk)
+                for record in chunk:
+                    if record['name'] not in errors:
+                        stats['deleted'] += 1
+                        continue
+                    record['attempts'] += 1
+                    if record['attempts'] >= max_attempts:
+                        failed.append(record)
+                        stats['failed'] += 1
+                    else:
+                        record['retry_at'] = now + backoff * 2 ** (record['attempts'] - 1)
+                        retry.append(record)
+                        stats['retried'] += 1
+                limiter(len(chunk))
+
+        write(path, retry)
+        write(os.path.join(path, FAILED_DIR), failed)
+        os.remove(work_path)
+    return stats
+
+
+def delete_records(deleter, model, field, storage, records):
+    '''Delete a chunk of records on one storage, sending the cleanup signals if the field exists'''
+    per_file = field is not None and (
+        cleanup_pre_delete.has_listeners(model) or cleanup_post_delete.has_listeners(model))
+    batch = field is not None and (
+        cleanup_pre_delete_batch.has_listeners(storage.__class__) or
+        cleanup_post_delete_batch.has_listeners(storage.__class__))
+    events = [make_event(model, field, record) for record in records] if per_file or batch else []
+    for event in events:
+        cleanup_pre_delete.send(sender=model, **event)
+    if batch:
+        cleanup_pre_delete_batch.send(sender=storage.__class__, storage=storage, events=events)
+
+    names = [record['name'] for record in records]
+    start = time.perf_counter()
+    try:
+        errors = deleter.delete(storage, names)
+    except Exception as ex:
+        errors = dict.fromkeys(names, ex)
+    backend = metrics.get_backend()
+    if backend is not None:
+        metrics.deletions_done(backend, [
+            (record['name'], record['model'], record['field']) for record in records],
+            errors, time.perf_counter() - start)
+
+    for record in records:
+        error = errors.get(record['name'])
+        if error is not None:
+            logger.error(
+                'There was an exception deleting the file `%s` on field `%s.%s`, attempt %s',
+                record['name'], record['model'], record['field'], record['attempts'] + 1,
+                exc_info=error)
+    post_events = []
+    for event in events:
+        error = errors.get(event['file_name'])
+        cleanup_post_delete.send(sender=model, error=error, success=error is None, **event)
+        post_events.append({**event, 'error': error, 'success': error is None})
+    if batch:
+        cleanup_post_delete_batch.send(
+            sender=storage.__class__, storage=storage, events=post_events)
+    return errors
@@ -0,0 +1,295 @@
+'''
+    Benchmarks of the django-cleanup signal handlers.
+
+    Measures the cost per row of post_init, a save that replaces files, a delete and queryset
+    iteration, with and without django-cleanup connected, for models with 0 to 10 file fields.
+
+    python -m test.benchmark
+    python -m test.benchmark --rows 5000 --json bench.json
+    python -m test.benchmark --compare bench.json --threshold 1.25
+    python -m test.benchmark --dispatch --models 500
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+def setup():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test.settings')
+    sys.path[:0] = [path for path in ('.', 'src') if path not in sys.path]
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+@contextmanager
+def cleanup_connected(connected):
+    '''Run the block with the django-cleanup handlers connected or disconnected'''
+    from django.db.models.signals import post_delete, post_init, post_save, pre_save
+
+    from django_cleanup import cache, handlers
+
+    signals = (post_init, pre_save, post_save, post_delete)
+    if connected:
+        yield
+        return
+    for model in cache.cleanup_models():
+        suffix = f'_django_cleanup_{cache.get_model_name(model)}'
+        for signal, prefix in zip(signals, ('post_init', 'pre_save', 'post_save', 'post_delete')):
+            signal.disconnect(None, sender=model, dispatch_uid=f'{prefix}{suffix}')
+    try:
+        yield
+    finally:
+        handlers.connect()
+
+
+def timed(func, repeat):
+    '''The best time of `repeat` runs of func, func returns the number of rows it handled'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = func()
+        elapsed = (time.perf_counter() - start) / rows
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def get_file_fields(model):
+    return [
+        field.attname for field in model._meta.concrete_fields
+        if field.attname.startswith('file')]
+
+
+def make_rows(model, rows):
+    from django.db import transaction
+
+    model.objects.all().delete()
+    fields = get_file_fields(model)
+    with transaction.atomic():
+        model.objects.bulk_create(
+            model(**{field: f'{field}-{index}.jpg' for field in fields}) for index in range(rows))
+
+
+def bench_init(model, rows):
+    fields = ['id', 'title'] + get_file_fields(model)
+    values = [(index, '') + tuple(f'{name}.jpg' for name in fields[2:]) for index in range(rows)]
+
+    def run():
+        for row in values:
+            model.from_db('default', fields, row)
+        return rows
+    return run
+
+
+def bench_iterate(model, rows, deferred=False):
+    def run():
+        queryset = model.objects.all()
+        if deferred:
+            queryset = queryset.defer(*get_file_fields(model)[1:])
+        return len(list(queryset.iterator(chunk_size=2000)))
+    return run
+
+
+def bench_save(model, rows):
+    from django.db import transaction
+
+    fields = get_file_fields(model)
+
+    def run():
+        instances = list(model.objects.all())
+        with transaction.atomic():
+            for instance in instances:
+                for field in fields:
+                    setattr(instance, field, f'{getattr(instance, field).name}x')
+                instance.save()
+        return len(instances)
+    return run
+
+
+def bench_delete(model, rows):
+    from django.db import transaction
+
+    def run():
+        make_rows(model, rows)
+        instances = list(model.objects.all())
+        with transaction.atomic():
+            for instance in instances:
+                instance.delete()
+        return len(instances)
+    return run
+
+
+BENCHMARKS = {
+    'post_init': bench_init,
+    'iterate': bench_iterate,
+    'iterate_deferred': lambda model, rows: bench_iterate(model, rows, deferred=True),
+    'save': bench_save,
+    'delete': bench_delete,
+}
+
+
+def run(rows=2000, repeat=3, benchmarks=None):
+    '''Run the benchmarks, returns a list of results with times in microseconds per row'''
+    from .models.benchmark import BENCHMARK_MODELS
+
+    results = []
+    for count, model in BENCHMARK_MODELS.items():
+        make_rows(model, rows)
+        for name, bench in BENCHMARKS.items():
+            if benchmarks and name not in benchmarks:
+                continue
+            times = {}
+            for connected in (False, True):
+                with cleanup_connected(connected):
+                    times[connected] = timed(bench(model, rows), repeat) * 1e6
+                make_rows(model, rows)
+            results.append({
+                'benchmark': name,
+                'file_fields': count,
+                'without': times[False],
+                'with': times[True],
+                'overhead': times[True] - times[False],
+            })
+    return results
+
+
+def make_dispatch_models(count):
+    '''Make `count` models with a file field and `count` without, like a project with many models'''
+    from django.db import models
+
+    from .models.benchmark import null_storage
+
+    made = []
+    for index in range(count):
+        for kind, fields in (('File', ('file',)), ('Plain', ())):
+            attrs = {'__module__': 'test.models.benchmark'}
+            for field in fields:
+                attrs[field] = models.FileField(
+                    upload_to='benchmark', blank=True, null=True, storage=null_storage)
+            made.append(type(f'Dispatch{kind}{index}', (models.Model,), attrs))
+    return made
+
+
+def remove_models(made):
+    from django.apps import apps
+
+    for model in made:
+        del apps.all_models[model._meta.app_label][model._meta.model_name]
+    apps.clear_cache()
+
+
+@contextmanager
+def dispatch_mode(mode):
+    '''
+        Prepare the cache and connect the handlers in a CLEANUP_DISPATCH mode, yields the seconds
+        to connect them
+    '''
+    from django_cleanup import cache, handlers
+
+    with cleanup_connected(False):
+        cache.FIELDS.clear()
+        cache.prepare(False)
+        start = time.perf_counter()
+        if mode == 'single':
+            handlers.connect_dispatchers()
+        else:
+            handlers.connect()
+        connect = time.perf_counter() - start
+        try:
+            yield connect
+        finally:
+            handlers.disconnect_dispatchers()
+
+
+def run_dispatch(models=500, rows=2000, repeat=3):
+    '''
+        Compare the receiver per cleanup model dispatch with the single dispatcher per signal, in
+        a project with `models` extra models with a file field and as many without. Returns a
+        list of results with the connect time in milliseconds and post_init in microseconds per row.
+    '''
+    from django_cleanup import cache
+
+    from .models.benchmark import Benchmark0, Benchmark1
+
+    made = make_dispatch_models(models)
+    try:
+        results = []
+        for mode in ('model', 'single'):
+            with dispatch_mode(mode) as connect:
+                results.append({
+                    'dispatch': mode,
+                    'models': models,
+                    'connect_ms': connect * 1e3,
+                    'post_init_file': timed(bench_init(Benchmark1, rows), repeat) * 1e6,
+                    'post_init_plain': timed(bench_init(Benchmark0, rows), repeat) * 1e6,
+                })
+        return results
+    finally:
+        with cleanup_connected(False):
+            remove_models(made)
+            cache.FIELDS.clear()
+            cache.prepare(False)
+
+
+def compare(results, baseline, threshold):
+    '''Returns the results whose overhead grew by more than threshold times the baseline'''
+    baseline = {(result['benchmark'], result['file_fields']): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline.get((result['benchmark'], result['file_fields']))
+        # ignore noise on overheads below a microsecond
+        if base is not None and result['overhead'] > max(base['overhead'], 1) * threshold:
+            regressions.append((result, base))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the django-cleanup handlers.')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--benchmark', action='append', choices=list(BENCHMARKS))
+    parser.add_argument('--json', help='Write the results to a json file.')
+    parser.add_argument('--compare', help='A json file of baseline results to compare against.')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    parser.add_argument(
+        '--dispatch', action='store_true',
+        help='Compare the CLEANUP_DISPATCH modes instead, with --models extra models.')
+    parser.add_argument('--models', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    setup()
+    if args.dispatch:
+        print(f"{'dispatch':<10}{'models':>8}{'connect ms':>12}{'post_init file us/row':>24}"
+              f"{'post_init plain us/row':>24}")
+        for result in run_dispatch(args.models, args.rows, args.repeat):
+            print(f"{result['dispatch']:<10}{result['models']:>8}{result['connect_ms']:>12.2f}"
+                  f"{result['post_init_file']:>24.2f}{result['post_init_plain']:>24.2f}")
+        return 0
+
+    results = run(args.rows, args.repeat, args.benchmark)
+    print(f"{'benchmark':<18}{'file fields':>12}{'without us/row':>16}{'with us/row':>14}"
+          f"{'overhead':>10}")
+    for result in results:
+        print(f"{result['benchmark']:<18}{result['file_fields']:>12}{result['without']:>16.2f}"
+              f"{result['with']:>14.2f}{result['overhead']:>10.2f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file_:
+            json.dump(results, file_, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file_:
+            regressions = compare(results, json.load(file_), args.threshold)
+        for result, base in regressions:
+            print(f"regression: {result['benchmark']} with {result['file_fields']} file fields, "
+                  f"overhead {base['overhead']:.2f} -> {result['overhead']:.2f} us/row")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
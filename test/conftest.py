@@ -8,6 +8,7 @@ from django.db.models.signals import post_delete, post_init, post_save, pre_save
 import pytest
 
 from django_cleanup import cache, handlers
+from django_cleanup.references import index
 
 from .testing_helpers import get_random_pic_name
 
@@ -31,9 +32,11 @@ def setup_django_cleanup_state(request, settings):
                              dispatch_uid=f'post_save{suffix}')
         post_delete.disconnect(None, sender=model,
                                dispatch_uid=f'post_delete{suffix}')
+    handlers.disconnect_dispatchers()
     cache.FIELDS.clear()
     cache.prepare(request.node.get_closest_marker('cleanup_selected_config') is not None)
     handlers.connect()
+    index.STATE['enabled'] = request.node.get_closest_marker('reference_index') is not None
 
     stroage_marker = request.node.get_closest_marker('django_storage')
     if stroage_marker is not None:
@@ -1,4 +1,5 @@
 from .app import *
+from .benchmark import *
 
 
 try:
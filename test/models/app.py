@@ -2,6 +2,7 @@ from django.db import models
 
 from django_cleanup import cleanup
 from django_cleanup.cleanup import cleanup_ignore
+from django_cleanup.query import CleanupQuerySet
 
 
 def default_image():
@@ -28,7 +29,7 @@ class ProductAbstract(models.Model):
 
 @cleanup.select
 class Product(ProductAbstract):
-    pass
+    objects = CleanupQuerySet.as_manager()
 
 
 @cleanup.ignore
@@ -56,3 +57,19 @@ class RootProduct(models.Model):
 class BranchProduct(models.Model):
     root = models.ForeignKey(RootProduct, on_delete=models.CASCADE)
     image = models.FileField(upload_to='test', blank=True, null=True)
+
+
+class FastRootProduct(models.Model):
+    pass
+
+
+@cleanup.fast_delete
+@cleanup.select
+class FastBranchProduct(models.Model):
+    root = models.ForeignKey(FastRootProduct, on_delete=models.CASCADE)
+    image = models.FileField(upload_to='test', blank=True, null=True)
+
+    objects = CleanupQuerySet.as_manager()
+
+    class Meta:
+        base_manager_name = 'objects'
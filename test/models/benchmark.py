@@ -0,0 +1,26 @@
+from django.db import models
+
+from ..storage import NullStorage
+
+
+# models with 0 to 10 file fields for test/benchmark.py
+FILE_FIELD_COUNTS = (0, 1, 3, 10)
+
+
+def null_storage():
+    return NullStorage()
+
+
+def make_benchmark_model(count):
+    attrs = {
+        '__module__': __name__,
+        'title': models.CharField(max_length=50, default=''),
+    }
+    for index in range(count):
+        attrs[f'file{index}'] = models.FileField(
+            upload_to='benchmark', blank=True, null=True, storage=null_storage)
+    return type(f'Benchmark{count}', (models.Model,), attrs)
+
+
+BENCHMARK_MODELS = {count: make_benchmark_model(count) for count in FILE_FIELD_COUNTS}
+Benchmark0, Benchmark1, Benchmark3, Benchmark10 = BENCHMARK_MODELS.values()
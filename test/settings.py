@@ -15,6 +15,7 @@ DATABASES = {
 INSTALLED_APPS = (
     'test',
     'django_cleanup',
+    'django_cleanup.references.apps.ReferencesConfig',
 )
 
 INSTALLED_APPS_INTEGRATION = (
@@ -11,3 +11,53 @@ class DeleteErrorStorage(FileSystemStorage):
         name = self.path(name)
         # If the file or directory exists, delete it from the filesystem.
         os.remove(name)
+
+
+class FakeBucket:
+    '''Stands in for a boto3 bucket, only multi-object delete is supported'''
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.calls = []
+
+    def delete_objects(self, Delete):
+        keys = [obj['Key'] for obj in Delete['Objects']]
+        self.calls.append(keys)
+        errors = []
+        for key in keys:
+            try:
+                os.remove(self.storage.path(key))
+            except FileNotFoundError:
+                errors.append({'Key': key, 'Code': 'NoSuchKey', 'Message': 'Not found'})
+        return {'Errors': errors}
+
+
+class BucketStorage(FileSystemStorage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = FakeBucket(self)
+
+    def _normalize_name(self, name):
+        return name
+
+
+class AsyncStorage(FileSystemStorage):
+    '''A storage with an async delete'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.adeleted = []
+
+    async def adelete(self, name):
+        self.adeleted.append(name)
+        super().delete(name)
+
+
+class NullStorage(FileSystemStorage):
+    '''A storage that never touches the disk, for benchmarks'''
+
+    def delete(self, name):
+        pass
+
+    def exists(self, name):
+        return False
@@ -1,24 +1,44 @@
+import asyncio
+import gc
+import io
+import json
 import logging
 import os
 import pickle
 import re
+import shutil
 import sys
 import tempfile
+import weakref
 
+from django.apps import apps as django_apps
 from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files import File
 from django.core.files.base import ContentFile
-from django.db import transaction
-from django.db.models.fields import NOT_PROVIDED, files
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.migrations.state import ProjectState
+from django.db.models import Count
+from django.db.models.fields import NOT_PROVIDED
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
+from django.test.utils import CaptureQueriesContext
 
 import pytest
 
-from django_cleanup import cache, handlers
-from django_cleanup.signals import cleanup_post_delete, cleanup_pre_delete
+from django_cleanup import (
+    apps, cache, cleanup, dangling, deletion, handlers, metrics, orphans, profiling, spool)
+from django_cleanup.query import CleanupQuerySet
+from django_cleanup.references import index
+from django_cleanup.references.models import FileReference
+from django_cleanup.signals import (
+    cleanup_post_delete, cleanup_post_delete_batch, cleanup_pre_delete, cleanup_pre_delete_batch)
 
 from . import storage
 from .models.app import (
-    BranchProduct, Product, ProductIgnore, ProductProxy, ProductUnmanaged, RootProduct)
+    BranchProduct, FastBranchProduct, FastRootProduct, Product, ProductIgnore, ProductProxy,
+    ProductUnmanaged, RootProduct)
 from .testing_helpers import get_random_pic_name, get_using
 
 
@@ -31,21 +51,16 @@ def get_traceback(picture):
     error = 'FileNotFoundError'
     if sys.version_info < (3, 13):
         return f'''Traceback (most recent call last):
-  File "{fileabspath(handlers.__file__)}", line xxx, in run_on_commit
-    file_.delete(save=False)
-  File "{fileabspath(files.__file__)}", line xxx, in delete
-    self.storage.delete(self.name)
+  File "{fileabspath(deletion.__file__)}", line xxx, in delete
+    storage.delete(name)
   File "{fileabspath(storage.__file__)}", line xxx, in delete
     os.remove(name)
 {error}: [Errno 2] No such file or directory: '{picture}\''''
     else:
         return f'''Traceback (most recent call last):
-  File "{fileabspath(handlers.__file__)}", line xxx, in run_on_commit
-    file_.delete(save=False)
-    ~~~~~~~~~~~~^^^^^^^^^^^^
-  File "{fileabspath(files.__file__)}", line xxx, in delete
-    self.storage.delete(self.name)
-    ~~~~~~~~~~~~~~~~~~~^^^^^^^^^^^
+  File "{fileabspath(deletion.__file__)}", line xxx, in delete
+    storage.delete(name)
+    ~~~~~~~~~~~~~~^^^^^^
   File "{fileabspath(storage.__file__)}", line xxx, in delete
     os.remove(name)
     ~~~~~~~~~^^^^^^
@@ -79,6 +94,124 @@ def test_cache_gone(picture):
     assert not os.path.exists(picture['path'])
 
 
+def test_fallback_only_file_columns(picture):
+    root = RootProduct.objects.create()
+    branch = BranchProduct.objects.create(root=root, image=picture['filename'])
+    with cleanup.readonly():
+        branch = BranchProduct(pk=branch.pk, root=root, image=get_random_pic_name())
+    assert not cache.has_cache(branch)
+    with CaptureQueriesContext(connection) as queries:
+        with transaction.atomic(get_using(branch)):
+            branch.save()
+    assert 'root_id' not in queries.captured_queries[0]['sql']
+    assert not os.path.exists(picture['path'])
+
+
+def test_fallback_disabled(picture, settings):
+    settings.CLEANUP_NO_FALLBACK_MODELS = ['test.product']
+    product = Product.objects.create(image=picture['filename'])
+    with cleanup.readonly():
+        product = Product(pk=product.pk, image=get_random_pic_name())
+    with CaptureQueriesContext(connection) as queries:
+        with transaction.atomic(get_using(product)):
+            product.save()
+    assert not any(query['sql'].startswith('SELECT') for query in queries.captured_queries)
+    assert os.path.exists(picture['path'])
+
+
+def test_refresh_from_db(picture):
+    products = [Product.objects.create(image=picture['filename'])]
+    products += [Product.objects.create(image=get_random_pic_name()) for _ in range(2)]
+    with cleanup.readonly():
+        products = [Product(pk=product.pk, image=product.image.name) for product in products]
+    with CaptureQueriesContext(connection) as queries:
+        cleanup.refresh_from_db(products + [Product()])
+    assert len(queries.captured_queries) == 1
+    assert cache.get_original_name(products[0], 'image') == picture['filename']
+    with CaptureQueriesContext(connection) as queries:
+        with transaction.atomic(get_using(products[0])):
+            for product in products:
+                product.image = get_random_pic_name()
+                product.save()
+    assert not any(query['sql'].startswith('SELECT') for query in queries.captured_queries)
+    assert not os.path.exists(picture['path'])
+
+
+def test_queryset_update(picture):
+    product = Product.objects.create(image=picture['filename'])
+    other = Product.objects.create(image='other.jpg')
+    new_name = get_random_pic_name()
+    with CaptureQueriesContext(connection) as queries:
+        assert Product.objects.filter(pk=product.pk).update(image=new_name) == 1
+    assert [query['sql'].split()[0] for query in queries.captured_queries] == [
+        'BEGIN', 'SELECT', 'UPDATE', 'COMMIT']
+    assert not os.path.exists(picture['path'])
+    assert Product.objects.get(pk=product.pk).image.name == new_name
+    assert Product.objects.get(pk=other.pk).image.name == 'other.jpg'
+
+
+def test_queryset_update_expression(picture):
+    from django.db.models import Value
+    from django.db.models.functions import Concat
+    product = Product.objects.create(image=picture['filename'])
+    Product.objects.filter(pk=product.pk).update(image=Concat(Value('x'), 'image'))
+    assert not os.path.exists(picture['path'])
+    assert Product.objects.get(pk=product.pk).image.name == f"x{picture['filename']}"
+
+
+def test_queryset_update_default(picture):
+    product = Product.objects.create(image=picture['filename'])
+    Product.objects.filter(pk=product.pk).update(image_default='other.jpg', image=None)
+    assert os.path.exists(picture['srcpath'])
+    assert not os.path.exists(picture['path'])
+
+
+def test_bulk_update(picture):
+    products = [Product.objects.create(image=picture['filename'])]
+    products += [Product.objects.create(image=get_random_pic_name()) for _ in range(2)]
+    new_names = [get_random_pic_name() for _ in products]
+    for product, new_name in zip(products, new_names):
+        product.image = new_name
+    with CaptureQueriesContext(connection) as queries:
+        Product.objects.bulk_update(products, ['image'])
+    assert [query['sql'].split()[0] for query in queries.captured_queries] == [
+        'BEGIN', 'SELECT', 'UPDATE', 'COMMIT']
+    assert not os.path.exists(picture['path'])
+    assert cache.get_original_name(products[0], 'image') == new_names[0]
+    assert [product.image.name for product in Product.objects.order_by('pk')] == new_names
+
+
+def test_bulk_update_filtered(picture):
+    excluded = Product.objects.create(image=picture['filename'])
+    product = Product.objects.create(image=get_random_pic_name())
+    for instance in (excluded, product):
+        instance.image = get_random_pic_name()
+    assert Product.objects.exclude(pk=excluded.pk).bulk_update([excluded, product], ['image']) == 1
+    assert os.path.exists(picture['path'])
+    assert Product.objects.get(pk=excluded.pk).image.name == picture['filename']
+    assert cache.get_original_name(excluded, 'image') == picture['filename']
+    assert cache.get_original_name(product, 'image') == product.image.name
+
+
+def test_update_locks_rows(picture, monkeypatch):
+    locked = []
+    def select_for_update(self, **kwargs):
+        locked.append((self.model, kwargs))
+        return self
+    monkeypatch.setattr(connection.features, 'has_select_for_update', True)
+    monkeypatch.setattr(connection.features, 'has_select_for_update_of', True)
+    monkeypatch.setattr(QuerySet, 'select_for_update', select_for_update)
+    product = Product.objects.create(image=picture['filename'])
+    Product.objects.update(image=get_random_pic_name())
+    product.image = get_random_pic_name()
+    Product.objects.bulk_update([product], ['image'])
+    assert locked == [(Product, {'of': ('self',)})] * 2
+    assert not os.path.exists(picture['path'])
+    # FOR UPDATE is not allowed with GROUP BY
+    Product.objects.annotate(count=Count('pk')).update(image=get_random_pic_name())
+    assert len(locked) == 2
+
+
 def test_storage_gone(picture):
     product = Product.objects.create(image=picture['filename'])
     assert os.path.exists(picture['path'])
@@ -90,6 +223,146 @@ def test_storage_gone(picture):
     assert not os.path.exists(picture['path'])
 
 
+def test_restore_field_and_storage(picture):
+    field = Product._meta.get_field('image')
+    assert cache.get_field('test.product', 'image') is field
+    assert cache.get_field_storage('test.product', 'image') is field.storage
+
+    product = Product.objects.create(image=picture['filename'])
+    file_ = cache.make_field_file(product, 'image', picture['filename'])
+    del file_.field, file_.storage
+    with transaction.atomic():
+        handlers.delete_file(Product, product, 'image', file_, 'default', 'deleted')
+    assert file_.field is field
+    assert file_.storage is field.storage
+    assert not os.path.exists(picture['path'])
+
+
+def test_restore_field_and_storage_gone(monkeypatch):
+    monkeypatch.setitem(
+        cache.FIELDS_INSTANCES['test.product'], 'image', (lambda: None, lambda: None))
+    field = cache.get_field('test.product', 'image')
+    assert field is not Product._meta.get_field('image')
+    assert field.name == 'image'
+    assert isinstance(cache.get_field_storage('test.product', 'image'), storage.FileSystemStorage)
+
+
+def test_cache_holds_names(picture):
+    product = Product.objects.create(image=picture['filename'])
+    product = Product.objects.get(pk=product.pk)
+    snapshot = getattr(product, cache.CACHE_NAME)
+    assert dict(snapshot.items()) == {
+        'image': picture['filename'],
+        'image_default': 'pic.jpg',
+        'image_default_callable': 'pic.jpg'
+    }
+    assert snapshot.fields is cache.get_plan(Product).names
+    assert 'image' not in product.__dict__ or isinstance(product.__dict__['image'], str)
+
+
+def test_cache_pickled_by_earlier_version(picture):
+    product = Product.objects.create(image=picture['filename'])
+    # the cache of 9.0.0 holds the field files
+    setattr(product, cache.CACHE_NAME, {
+        field.name: getattr(product, field.name) for field in cache.get_plan(Product).fields})
+    product = pickle.loads(pickle.dumps(product))
+    product.image = get_random_pic_name()
+    with transaction.atomic(get_using(product)):
+        product.save()
+    assert not os.path.exists(picture['path'])
+    assert isinstance(cache.get_cache(product), cache.Snapshot)
+
+
+def test_cache_pickle(picture):
+    product = Product.objects.create(image=picture['filename'])
+    snapshot = pickle.loads(pickle.dumps(cache.get_cache(product)))
+    assert isinstance(snapshot, cache.Snapshot)
+    assert dict(snapshot.items()) == dict(cache.get_cache(product).items())
+    assert snapshot['image'] == picture['filename']
+    assert snapshot.get('missing') is None
+    with pytest.raises(KeyError):
+        snapshot['missing']
+    assert len(pickle.dumps(snapshot)) < 150
+
+    product = Product.objects.only('image').get(pk=product.pk)
+    assert list(cache.get_cache(product)) == ['image']
+
+
+def test_model_plan():
+    plan = cache.get_plan(Product)
+    assert plan.model_name == 'test.product'
+    assert [field.name for field in plan.fields] == [
+        'image', 'image_default', 'image_default_callable']
+    assert plan.fields_by_name['image_default'].default == 'pic.jpg'
+    assert plan.fields_by_name['image'].storage is Product._meta.get_field('image').storage
+    assert cache.get_plan(ProductProxy).model_name == 'test.productproxy'
+    assert cache.get_plan(RootProduct) is cache.EMPTY_PLAN
+
+
+@pytest.fixture
+def counted_default(monkeypatch):
+    calls = []
+    def default():
+        calls.append(1)
+        return f'default{len(calls)}.jpg'
+    plan = cache.get_plan(Product)
+    field = plan.fields_by_name['image_default_callable']._replace(default=default)
+    monkeypatch.setitem(cache.PLANS, Product, plan._replace(
+        fields_by_name={**plan.fields_by_name, field.name: field}))
+    return calls
+
+
+def test_default_name_cached(counted_default):
+    for _ in range(3):
+        assert cache.get_default_name(Product, 'image_default_callable') == 'default1.jpg'
+    assert len(counted_default) == 1
+    cleanup.refresh_defaults(ProductProxy)
+    assert cache.get_default_name(Product, 'image_default_callable') == 'default1.jpg'
+    cleanup.refresh_defaults(Product)
+    assert cache.get_default_name(Product, 'image_default_callable') == 'default2.jpg'
+    cleanup.refresh_defaults()
+    assert cache.get_default_name(Product, 'image_default_callable') == 'default3.jpg'
+
+
+def test_default_name_dynamic(counted_default, settings):
+    settings.CLEANUP_DYNAMIC_DEFAULTS = ('test.product.image_default_callable',)
+    assert cache.get_default_name(Product, 'image_default_callable') == 'default1.jpg'
+    assert cache.get_default_name(Product, 'image_default_callable') == 'default2.jpg'
+
+
+def test_names_deferred(picture):
+    product = Product.objects.create(image=picture['filename'])
+    product = Product.objects.defer('image_default').get(pk=product.pk)
+    assert dict(cache.names_for_model_instance(product)) == {
+        'image': picture['filename'], 'image_default_callable': 'pic.jpg'}
+
+
+def test_readonly(picture):
+    product = Product.objects.create(image=picture['filename'])
+    with cleanup.readonly():
+        product = Product.objects.get(pk=product.pk)
+    assert not cache.has_cache(product)
+    product.image = get_random_pic_name()
+    with transaction.atomic(get_using(product)):
+        product.save()
+    assert not os.path.exists(picture['path'])
+
+
+def test_without_cleanup(picture):
+    Product.objects.create(image=picture['filename'])
+    products = list(Product.objects.without_cleanup().iterator(chunk_size=1))
+    assert products
+    assert not any(cache.has_cache(product) for product in products)
+    assert list(Product.objects.without_cleanup().values_list('image', flat=True)) == [
+        picture['filename']]
+    product = products[0]
+    assert cache.has_cache(Product.objects.get(pk=product.pk))
+    product.image = get_random_pic_name()
+    with transaction.atomic(get_using(product)):
+        product.save()
+    assert not os.path.exists(picture['path'])
+
+
 def test_replace_file_with_file(picture):
     product = Product.objects.create(image=picture['filename'])
     assert os.path.exists(picture['path'])
@@ -408,6 +681,961 @@ def test_signals(picture):
     cleanup_post_delete.disconnect(None, dispatch_uid='post_test_replace_file_with_file_signals')
 
 
+#region batched deletion
+def test_batch_delete(picture, monkeypatch):
+    names = [get_random_pic_name() for _ in range(5)]
+    for name in names:
+        Product.objects.create(image=name)
+    Product.objects.create(image=names[0])
+    Product.objects.create(image=picture['filename'])
+    deleted = []
+    storage_ = Product._meta.get_field('image').storage
+    monkeypatch.setattr(storage_, 'delete', deleted.append)
+    with transaction.atomic():
+        Product.objects.all().delete()
+        connection = transaction.get_connection()
+        assert len(connection.run_on_commit) == 1
+    assert sorted(deleted) == sorted(names + [picture['filename']])
+
+
+def test_batch_savepoint_rollback(picture):
+    product = Product.objects.create(image=picture['filename'])
+    other = Product.objects.create(image='no-such-file')
+    with transaction.atomic():
+        other.delete()
+        try:
+            with transaction.atomic():
+                product.delete()
+                raise ValueError
+        except ValueError:
+            pass
+    assert os.path.exists(picture['path'])
+
+
+def test_batch_coalesce(monkeypatch):
+    names = [get_random_pic_name() for _ in range(4)]
+    product = Product.objects.create(image=names[0])
+    other = Product.objects.create(image=names[0])
+    deleted = []
+    storage_ = Product._meta.get_field('image').storage
+    monkeypatch.setattr(storage_, 'delete', deleted.append)
+    with transaction.atomic():
+        connection = transaction.get_connection()
+        product.image = names[1]
+        product.save()
+        for name in names[2:]:
+            with transaction.atomic():
+                product.image = name
+                product.save()
+        other.image = names[1]
+        other.save()
+        # one batch for the transaction and one per savepoint, files saved after a savepoint is
+        # released join its batch
+        assert len(connection.run_on_commit) == 3
+    assert sorted(deleted) == sorted(names[:3])
+
+
+def test_batch_coalesce_savepoint_rollback(monkeypatch):
+    names = [get_random_pic_name() for _ in range(3)]
+    products = [Product.objects.create(image=name) for name in names]
+    deleted = []
+    storage_ = Product._meta.get_field('image').storage
+    monkeypatch.setattr(storage_, 'delete', deleted.append)
+    with transaction.atomic():
+        with transaction.atomic():
+            products[0].delete()
+        products[1].delete()
+        try:
+            with transaction.atomic():
+                products[2].delete()
+                raise ValueError
+        except ValueError:
+            pass
+    assert sorted(deleted) == sorted(names[:2])
+
+
+def test_batch_spill(picture, monkeypatch, settings):
+    settings.CLEANUP_SPILL_THRESHOLD = 2
+    names = [get_random_pic_name() for _ in range(4)]
+    for name in names + [names[0], picture['filename']]:
+        Product.objects.create(image=name)
+    deleted = []
+    storage_ = Product._meta.get_field('image').storage
+    monkeypatch.setattr(storage_, 'delete', deleted.append)
+    instances = []
+    def receiver(instance, **kwargs):
+        instances.append(instance)
+    cleanup_pre_delete.connect(receiver, dispatch_uid='test_batch_spill')
+    try:
+        with transaction.atomic():
+            Product.objects.all().delete()
+            batch, _ = deletion.get_batches(None)
+            assert batch.spill_file is not None
+            assert batch.size < 2
+    finally:
+        cleanup_pre_delete.disconnect(None, dispatch_uid='test_batch_spill')
+    assert sorted(deleted) == sorted(names + [picture['filename']])
+    # the instances the queryset loaded are gone by the commit
+    assert instances == [None] * 5
+    assert batch.spill_file is None
+    # the duplicates of a spilled batch are removed on disk, its names are not kept in memory
+    assert not any(batch.deleted.values())
+
+
+def test_batch_does_not_keep_instances(picture):
+    product = Product.objects.create(image=picture['filename'])
+    pk = product.pk
+    instances = []
+    def receiver(instance, **kwargs):
+        instances.append(instance)
+    cleanup_post_delete.connect(receiver, dispatch_uid='test_batch_does_not_keep_instances')
+    try:
+        with transaction.atomic():
+            product.delete()
+            batch, _ = deletion.get_batches(None)
+            (record,) = batch.storages[Product._meta.get_field('image').storage].values()
+            assert record[:6] == (
+                record.storage, picture['filename'], 'test.product', 'image', 'deleted', pk)
+            product_ref = weakref.ref(product)
+            del product
+            gc.collect()
+            assert product_ref() is None
+    finally:
+        cleanup_post_delete.disconnect(None, dispatch_uid='test_batch_does_not_keep_instances')
+    assert instances == [None]
+    assert not os.path.exists(picture['path'])
+
+
+def test_batch_chunks(picture, monkeypatch, settings):
+    settings.CLEANUP_BULK_DELETER = 'test.test_all.ChunkDeleter'
+    ChunkDeleter.calls = []
+    names = [get_random_pic_name() for _ in range(5)] + [picture['filename']]
+    for name in names:
+        Product.objects.create(image=name)
+    with transaction.atomic():
+        Product.objects.all().delete()
+    assert [len(call) for call in ChunkDeleter.calls] == [2, 2, 2]
+    assert not os.path.exists(picture['path'])
+
+
+def test_batch_signals(picture, settings):
+    settings.CLEANUP_BULK_DELETER = 'test.test_all.ChunkDeleter'
+    names = [get_random_pic_name() for _ in range(2)] + [picture['filename']]
+    for name in names:
+        Product.objects.create(image=name)
+    calls = []
+    def receiver(signal, **kwargs):
+        calls.append((signal, kwargs))
+    cleanup_pre_delete_batch.connect(receiver, dispatch_uid='test_batch_signals')
+    cleanup_post_delete_batch.connect(receiver, dispatch_uid='test_batch_signals')
+    try:
+        with transaction.atomic():
+            Product.objects.all().delete()
+        with cleanup.dry_run():
+            with transaction.atomic():
+                Product.objects.create(image=picture['filename']).delete()
+    finally:
+        cleanup_pre_delete_batch.disconnect(None, dispatch_uid='test_batch_signals')
+        cleanup_post_delete_batch.disconnect(None, dispatch_uid='test_batch_signals')
+    assert [signal for signal, _ in calls] == [
+        cleanup_pre_delete_batch, cleanup_post_delete_batch, cleanup_pre_delete_batch]
+    (_, pre), (_, post), (_, dry_run) = calls
+    storage_ = Product._meta.get_field('image').storage
+    assert pre['sender'] is storage_.__class__
+    assert pre['storage'] is storage_ and post['storage'] is storage_
+    assert sorted(event['file_name'] for event in pre['events']) == sorted(names)
+    assert sorted(event['file_name'] for event in post['events']) == sorted(names)
+    assert all(event['success'] and event['error'] is None for event in post['events'])
+    assert post['events'][0]['model_name'] == 'test.product'
+    assert dry_run['dry_run'] is True
+    assert [event['file_name'] for event in dry_run['events']] == [picture['filename']]
+    assert not os.path.exists(picture['path'])
+
+
+def test_batch_signals_deduplicated(picture):
+    product = Product.objects.create(image=picture['filename'])
+    copy = Product.objects.create(image=picture['filename'])
+    calls = []
+    def receiver(signal, **kwargs):
+        calls.append((signal, kwargs))
+    cleanup_pre_delete_batch.connect(receiver, dispatch_uid='test_batch_signals_deduplicated')
+    cleanup_post_delete_batch.connect(receiver, dispatch_uid='test_batch_signals_deduplicated')
+    try:
+        with transaction.atomic():
+            product.delete()
+            # the batch of the savepoint only has the file the first batch deletes
+            with transaction.atomic():
+                copy.delete()
+    finally:
+        cleanup_pre_delete_batch.disconnect(None, dispatch_uid='test_batch_signals_deduplicated')
+        cleanup_post_delete_batch.disconnect(None, dispatch_uid='test_batch_signals_deduplicated')
+    assert [signal for signal, _ in calls] == [cleanup_pre_delete_batch, cleanup_post_delete_batch]
+    assert not os.path.exists(picture['path'])
+
+
+def test_batch_without_receivers(picture, monkeypatch):
+    assert not cleanup_pre_delete.has_listeners(Product)
+    Product.objects.create(image=picture['filename'])
+    monkeypatch.setattr(deletion, 'make_events', _raise('no receivers'))
+    with transaction.atomic():
+        Product.objects.all().delete()
+    assert not os.path.exists(picture['path'])
+
+
+class ChunkDeleter(deletion.BulkDeleter):
+    chunk_size = 2
+    calls = []
+
+    def delete(self, storage, names):
+        self.calls.append(names)
+        return super().delete(storage, names)
+
+
+@pytest.mark.django_storage(default='test.storage.BucketStorage')
+def test_s3_bulk_deleter(picture, settings):
+    settings.CLEANUP_BULK_DELETER = 'django_cleanup.deletion.S3BulkDeleter'
+    postkwargs = []
+    def assn_postkwargs(**kwargs):
+        postkwargs.append(kwargs)
+    cleanup_post_delete.connect(assn_postkwargs, dispatch_uid='post_test_s3_bulk_deleter')
+    product = Product.objects.create(image=picture['filename'])
+    missing = Product.objects.create(image='no-such-file')
+    with transaction.atomic():
+        product.delete()
+        missing.delete()
+    cleanup_post_delete.disconnect(None, dispatch_uid='post_test_s3_bulk_deleter')
+    assert not os.path.exists(picture['path'])
+    assert product.image.storage.bucket.calls == [[picture['filename'], 'no-such-file']]
+    assert [(kwargs['file_name'], kwargs['success']) for kwargs in postkwargs] == [
+        (picture['filename'], True), ('no-such-file', False)]
+    assert str(postkwargs[1]['error']) == 'NoSuchKey: Not found'
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_executor(picture, settings, executor):
+    settings.CLEANUP_EXECUTOR = executor
+    settings.CLEANUP_EXECUTOR_WORKERS = 2
+    postkwargs = []
+    def assn_postkwargs(**kwargs):
+        postkwargs.append(kwargs)
+    cleanup_post_delete.connect(assn_postkwargs, dispatch_uid='post_test_executor')
+    product = Product.objects.create(image=picture['filename'])
+    try:
+        with transaction.atomic(get_using(product)):
+            product.delete()
+        deletion.shutdown_executors()
+    finally:
+        cleanup_post_delete.disconnect(None, dispatch_uid='post_test_executor')
+    assert not os.path.exists(picture['path'])
+    assert [(kwargs['file_name'], kwargs['success']) for kwargs in postkwargs] == [
+        (picture['filename'], True)]
+
+
+def test_executor_inline_receiver_error(picture):
+    def receiver(**kwargs):
+        raise ValueError
+    cleanup_post_delete.connect(receiver, dispatch_uid='post_test_executor_error')
+    product = Product.objects.create(image=picture['filename'])
+    try:
+        with pytest.raises(ValueError):
+            with transaction.atomic(get_using(product)):
+                product.delete()
+    finally:
+        cleanup_post_delete.disconnect(None, dispatch_uid='post_test_executor_error')
+    assert not os.path.exists(picture['path'])
+
+
+def test_executor_invalid(settings):
+    settings.CLEANUP_EXECUTOR = 'fibers'
+    with pytest.raises(ImproperlyConfigured):
+        deletion.get_executor()
+#endregion
+
+
+#region dry run
+def test_dry_run(picture):
+    product = Product.objects.create(image=picture['filename'])
+    pk = product.pk
+    other = Product.objects.create(image=get_random_pic_name())
+    prekwargs = []
+    cleanup_pre_delete.connect(
+        lambda **kwargs: prekwargs.append(kwargs), weak=False, dispatch_uid='pre_test_dry_run')
+    try:
+        with cleanup.dry_run() as plan:
+            with transaction.atomic():
+                product.delete()
+            with transaction.atomic():
+                other.delete()
+                transaction.set_rollback(True)
+    finally:
+        cleanup_pre_delete.disconnect(None, dispatch_uid='pre_test_dry_run')
+    assert os.path.exists(picture['path'])
+    assert len(plan) == 1
+    assert plan.counts == {('test.product', 'image'): 1}
+    assert [deletion[1:] for deletion in plan.deletions] == [
+        (picture['filename'], 'test.product', 'image', 'deleted', pk)]
+    assert len(prekwargs) == 1
+    assert prekwargs[0]['dry_run'] is True
+    assert prekwargs[0]['file_name'] == picture['filename']
+
+
+def test_dry_run_setting(picture, settings):
+    settings.CLEANUP_DRY_RUN = True
+    plan = cleanup.dry_run_plan()
+    plan.clear()
+    product = Product.objects.create(image=picture['filename'])
+    product.image = get_random_pic_name()
+    with transaction.atomic():
+        product.save()
+    assert os.path.exists(picture['path'])
+    assert [deletion.reason for deletion in plan.deletions] == ['updated']
+    plan.clear()
+#endregion
+
+
+#region metrics
+def test_metrics(picture, settings, monkeypatch):
+    settings.CLEANUP_METRICS_BACKEND = 'django_cleanup.metrics.InMemoryBackend'
+    backend = metrics.get_backend()
+    tags = {'model_name': 'test.product', 'field_name': 'image'}
+    product = Product.objects.create(image=picture['filename'])
+    # made in post_init and remade in post_save
+    assert backend.get('snapshots', model_name='test.product') == 2
+
+    with cleanup.readonly():
+        product = Product.objects.get(pk=product.pk)
+    product.image = get_random_pic_name()
+    with transaction.atomic():
+        product.save()
+    assert backend.get('fallback_queries', model_name='test.product') == 1
+    assert backend.get('deletions_queued', **tags) == 1
+    assert backend.get('deletions_succeeded', **tags) == 1
+    assert not os.path.exists(picture['path'])
+
+    storage_ = Product._meta.get_field('image').storage
+    monkeypatch.setattr(storage_, 'delete', _raise('no such file'))
+    with transaction.atomic():
+        product.delete()
+    assert backend.get('deletions_queued', **tags) == 2
+    assert backend.get('deletions_failed', **tags) == 1
+    histogram = backend.get_histogram('delete_seconds', **tags)
+    assert histogram.count == 2
+    assert histogram.buckets[float('inf')] == 2
+
+
+def test_metrics_disabled(picture):
+    assert metrics.get_backend() is None
+    Product.objects.create(image=picture['filename'])
+#endregion
+
+
+#region profiling
+def test_profile(picture):
+    with cleanup.profile() as profile:
+        product = Product.objects.create(image=picture['filename'])
+        product.image = get_random_pic_name()
+        with transaction.atomic():
+            product.save()
+    product.delete()
+    report = profile.report()
+    assert {(entry.handler, entry.model_name): entry.calls for entry in report} == {
+        ('cache_original_post_init', 'test.product'): 1,
+        ('fallback_pre_save', 'test.product'): 2,
+        ('delete_old_post_save', 'test.product'): 2,
+        ('delete_file', 'test.product'): 1,
+    }
+    assert [entry.seconds for entry in report] == sorted(
+        (entry.seconds for entry in report), reverse=True)
+
+
+def test_profile_setting(picture, settings):
+    settings.CLEANUP_PROFILE = True
+    Product.objects.create(image=picture['filename'])
+    handlers = {entry.handler for entry in cleanup.profile_report()}
+    assert {'cache_original_post_init', 'delete_old_post_save'} <= handlers
+    settings.CLEANUP_PROFILE = False
+    profiling.SETTING_PROFILE.clear()
+
+
+def test_profile_command(picture):
+    Product.objects.create(image=picture['filename'])
+    stdout = io.StringIO()
+    call_command('cleanup_profile', '--rows', '10', stdout=stdout)
+    lines = stdout.getvalue().splitlines()
+    assert lines[0].split() == ['handler', 'model', 'calls', 'total', 'ms', 'us/call']
+    assert ['cache_original_post_init', 'test.product', '1'] in [
+        line.split()[:3] for line in lines[1:]]
+#endregion
+
+
+#region async deletion
+@pytest.mark.parametrize('storage_backend', [
+    'test.storage.AsyncStorage', 'django.core.files.storage.FileSystemStorage'])
+def test_async(picture, settings, storage_backend):
+    settings.STORAGES = {**settings.STORAGES, 'default': {'BACKEND': storage_backend}}
+    settings.CLEANUP_ASYNC = True
+    postkwargs = {}
+    def assn_postkwargs(**kwargs):
+        nonlocal postkwargs
+        postkwargs = kwargs
+    cleanup_post_delete.connect(assn_postkwargs, dispatch_uid='post_test_async')
+
+    async def main():
+        product = await Product.objects.acreate(image=picture['filename'])
+        await product.adelete()
+        assert deletion.PENDING
+        await deletion.wait_async()
+
+    try:
+        asyncio.run(main())
+    finally:
+        cleanup_post_delete.disconnect(None, dispatch_uid='post_test_async')
+    assert not os.path.exists(picture['path'])
+    assert postkwargs['success'] is True
+    assert not deletion.PENDING
+    storage_ = Product._meta.get_field('image').storage
+    assert getattr(storage_, 'adeleted', [picture['filename']]) == [picture['filename']]
+
+
+def test_async_sync_context(picture, settings):
+    settings.CLEANUP_ASYNC = True
+    product = Product.objects.create(image=picture['filename'])
+    with transaction.atomic(get_using(product)):
+        product.delete()
+    assert not deletion.PENDING
+    assert not os.path.exists(picture['path'])
+#endregion
+
+
+#region deletion spool
+def test_spool(picture, settings, tmp_path):
+    settings.CLEANUP_QUEUE_PATH = str(tmp_path)
+    product = Product.objects.create(image=picture['filename'])
+    pk = product.pk
+    with transaction.atomic(get_using(product)):
+        product.delete()
+    assert os.path.exists(picture['path'])
+    spool_files = os.listdir(tmp_path)
+    assert len(spool_files) == 1
+    assert spool.read(os.path.join(tmp_path, spool_files[0])) == [{
+        'storage': 'django.core.files.storage.filesystem.FileSystemStorage',
+        'model': 'test.product',
+        'field': 'image',
+        'name': picture['filename'],
+        'reason': 'deleted',
+        'pk': pk,
+        'attempts': 0,
+        'retry_at': 0
+    }]
+
+    prekwargs = {}
+    def assn_prekwargs(**kwargs):
+        nonlocal prekwargs
+        prekwargs = kwargs
+    postbatch = {}
+    def assn_postbatch(**kwargs):
+        postbatch.update(kwargs)
+    cleanup_pre_delete.connect(assn_prekwargs, dispatch_uid='pre_test_spool')
+    cleanup_post_delete_batch.connect(assn_postbatch, dispatch_uid='post_batch_test_spool')
+    stdout = io.StringIO()
+    try:
+        call_command('cleanup_worker', '--once', stdout=stdout)
+    finally:
+        cleanup_pre_delete.disconnect(None, dispatch_uid='pre_test_spool')
+        cleanup_post_delete_batch.disconnect(None, dispatch_uid='post_batch_test_spool')
+    assert not os.path.exists(picture['path'])
+    assert os.listdir(tmp_path) == []
+    assert stdout.getvalue().startswith('Deleted 1 files, 0 failed, 0 to retry, 0 deferred in ')
+    assert prekwargs['file_name'] == picture['filename']
+    assert prekwargs['instance'] is None
+    assert prekwargs['deleted'] is True
+    assert [event['file_name'] for event in postbatch['events']] == [picture['filename']]
+    assert postbatch['events'][0]['success'] is True
+
+
+@pytest.mark.django_storage(default='test.storage.DeleteErrorStorage')
+def test_spool_retry(settings, tmp_path):
+    settings.CLEANUP_QUEUE_PATH = str(tmp_path)
+    product = Product.objects.create(image='no-such-file')
+    with transaction.atomic(get_using(product)):
+        product.delete()
+
+    assert spool.drain(str(tmp_path), backoff=0) == {
+        'deleted': 0, 'failed': 0, 'retried': 1, 'deferred': 0}
+    (spool_file,) = os.listdir(tmp_path)
+    (record,) = spool.read(os.path.join(tmp_path, spool_file))
+    assert record['attempts'] == 1
+
+    assert spool.drain(str(tmp_path), max_attempts=2, backoff=0) == {
+        'deleted': 0, 'failed': 1, 'retried': 0, 'deferred': 0}
+    assert os.listdir(tmp_path) == [spool.FAILED_DIR]
+    (failed_file,) = os.listdir(tmp_path / spool.FAILED_DIR)
+    (record,) = spool.read(os.path.join(tmp_path, spool.FAILED_DIR, failed_file))
+    assert record['attempts'] == 2
+#endregion
+
+
+#region reference index
+def get_reference_count(name):
+    storage_ = 'django.core.files.storage.filesystem.FileSystemStorage'
+    reference = FileReference.objects.filter(key=index.make_key(storage_, name)).first()
+    return reference.count if reference else 0
+
+
+@pytest.mark.reference_index
+def test_reference_shared_file(picture):
+    product = Product.objects.create(image=picture['filename'])
+    copy = Product.objects.create(image=picture['filename'])
+    assert get_reference_count(picture['filename']) == 2
+    assert get_reference_count('pic.jpg') == 0
+    with transaction.atomic(get_using(product)):
+        product.delete()
+    assert os.path.exists(picture['path'])
+    assert get_reference_count(picture['filename']) == 1
+
+    copy.image = get_random_pic_name()
+    with transaction.atomic(get_using(copy)):
+        copy.save()
+    assert not os.path.exists(picture['path'])
+    assert get_reference_count(picture['filename']) == 0
+    assert get_reference_count(copy.image.name) == 1
+
+
+@pytest.mark.reference_index
+def test_reference_rollback(picture):
+    product = Product.objects.create(image=picture['filename'])
+    try:
+        with transaction.atomic(get_using(product)):
+            Product.objects.create(image=picture['filename'])
+            raise ValueError
+    except ValueError:
+        pass
+    assert get_reference_count(picture['filename']) == 1
+    with transaction.atomic(get_using(product)):
+        product.delete()
+    assert not os.path.exists(picture['path'])
+
+
+@pytest.mark.reference_index
+def test_reference_bulk_update(picture):
+    product = Product.objects.create(image=picture['filename'])
+    Product.objects.create(image=picture['filename'])
+    Product.objects.filter(pk=product.pk).update(image='other.jpg')
+    assert os.path.exists(picture['path'])
+    assert get_reference_count(picture['filename']) == 1
+    assert get_reference_count('other.jpg') == 1
+
+
+@pytest.mark.reference_index
+def test_reference_deferred(picture):
+    product = Product.objects.create(image=picture['filename'])
+    product = Product.objects.defer('image').get(pk=product.pk)
+    assert product.image.name == picture['filename']
+    product.save()
+    assert get_reference_count(picture['filename']) == 1
+    with transaction.atomic(get_using(product)):
+        product.delete()
+    assert not os.path.exists(picture['path'])
+
+
+@pytest.mark.reference_index
+def test_reference_rebuild(picture):
+    Product.objects.create(image=picture['filename'])
+    Product.objects.create(image=picture['filename'])
+    FileReference.objects.all().delete()
+    stdout = io.StringIO()
+    call_command('cleanup_rebuild_references', stdout=stdout)
+    assert stdout.getvalue() == 'Indexed 1 files.\n'
+    assert get_reference_count(picture['filename']) == 2
+
+
+def test_reference_disabled():
+    with pytest.raises(CommandError):
+        call_command('cleanup_rebuild_references')
+    Product.objects.create(image='other.jpg')
+    assert not FileReference.objects.exists()
+#endregion
+
+
+#region orphans
+@pytest.fixture
+def orphans_directory():
+    directory = os.path.join(django_settings.MEDIA_ROOT, 'orphans')
+    os.makedirs(os.path.join(directory, 'sub'))
+    for name in ('kept.jpg', 'orphan.jpg', 'sub/orphan.jpg', 'sub/orphan.tmp'):
+        with open(os.path.join(directory, name), 'wb') as file_:
+            file_.write(b'file')
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_orphans_dry_run(orphans_directory):
+    Product.objects.create(image='orphans/kept.jpg')
+    stdout = io.StringIO()
+    call_command(
+        'cleanup_orphans', '--prefix', 'orphans', '--min-age', '0', '--exclude', '*.tmp',
+        '--workers', '2', '--field', 'test.product.image', stdout=stdout)
+    lines = stdout.getvalue().splitlines()
+    assert 'orphans/orphan.jpg' in lines
+    assert 'orphans/sub/orphan.jpg' in lines
+    assert 'orphans/kept.jpg' not in lines
+    assert 'orphans/sub/orphan.tmp' not in lines
+    assert lines[-1] == 'Found 2 orphaned files, dry run, nothing was deleted.'
+    assert os.path.exists(os.path.join(orphans_directory, 'orphan.jpg'))
+
+
+def test_orphans_delete(orphans_directory, tmp_path):
+    Product.objects.create(image='orphans/kept.jpg')
+    output = tmp_path / 'orphans.txt'
+    stdout = io.StringIO()
+    call_command(
+        'cleanup_orphans', '--prefix', 'orphans', '--min-age', '0', '--delete',
+        '--field', 'test.product.image', '--output', str(output), '--run-size', '1', stdout=stdout)
+    assert stdout.getvalue().splitlines()[-1] == 'Found 3 orphaned files, deleted 3.'
+    assert sorted(output.read_text().splitlines()) == [
+        'orphans/orphan.jpg', 'orphans/sub/orphan.jpg', 'orphans/sub/orphan.tmp']
+    assert sorted(os.listdir(orphans_directory)) == ['kept.jpg', 'sub']
+    assert os.listdir(os.path.join(orphans_directory, 'sub')) == []
+    assert os.path.exists(os.path.join(django_settings.MEDIA_ROOT, 'pic.jpg'))
+
+
+def test_orphans_min_age(orphans_directory):
+    stdout = io.StringIO()
+    call_command('cleanup_orphans', '--prefix', 'orphans', '--delete', stdout=stdout)
+    assert stdout.getvalue().splitlines()[-1] == 'Found 0 orphaned files, deleted 0.'
+
+    assert os.path.exists(os.path.join(orphans_directory, 'orphan.jpg'))
+
+
+def test_orphans_field_invalid():
+    with pytest.raises(CommandError):
+        call_command('cleanup_orphans', '--field', 'test.product.title')
+
+
+def test_orphans_external_sort(tmp_path):
+    sorters = [orphans.ExternalSort(str(tmp_path), run_size=2) for _ in range(2)]
+    for sorter, names in zip(sorters, (['c', 'a', 'b\nx', 'a'], ['b', 'c\n', 'd\re'])):
+        for name in names:
+            sorter.add(orphans.encode(name))
+    assert len(sorters[0].runs) == 2
+    assert [orphans.decode(line) for line in orphans.ExternalSort.merge(sorters)] == [
+        'a', 'b', 'b\nx', 'c', 'c\n', 'd\re']
+
+
+def test_orphans_carriage_return(orphans_directory):
+    with open(os.path.join(orphans_directory, 'kept\r.jpg'), 'wb') as file_:
+        file_.write(b'file')
+    Product.objects.create(image='orphans/kept\r.jpg')
+    stdout = io.StringIO()
+    call_command(
+        'cleanup_orphans', '--prefix', 'orphans', '--min-age', '0', '--field',
+        'test.product.image', '--run-size', '1', stdout=stdout)
+    assert stdout.getvalue().splitlines()[-1] == (
+        'Found 4 orphaned files, dry run, nothing was deleted.')
+#endregion
+
+
+#region dangling references
+def read_report(path):
+    with open(path, encoding='utf-8') as file_:
+        return [json.loads(line) for line in file_]
+
+
+def test_dangling(picture, tmp_path):
+    kept = Product.objects.create(image=picture['filename'])
+    with cleanup.readonly():
+        missing = [Product.objects.create(image='missing.jpg') for _ in range(2)]
+    report = tmp_path / 'report.jsonl'
+    stdout = io.StringIO()
+    call_command('cleanup_dangling', str(report), '--chunk-size', '1', stdout=stdout)
+    assert stdout.getvalue().startswith('Checked 9 rows, 2 files missing')
+    assert read_report(report) == [
+        {'field': 'test.product.image', 'pk': product.pk, 'name': 'missing.jpg'}
+        for product in missing]
+    assert kept.pk not in [row['pk'] for row in read_report(report)]
+
+
+def test_dangling_dedupe(monkeypatch, tmp_path):
+    for _ in range(3):
+        Product.objects.create(image='missing.jpg')
+    checked = []
+    exists = storage.FileSystemStorage.exists
+    monkeypatch.setattr(
+        storage.FileSystemStorage, 'exists',
+        lambda self, name: checked.append(name) or exists(self, name))
+    dangling.check(str(tmp_path / 'report.jsonl'))
+    assert checked.count('missing.jpg') == 1
+
+
+def test_dangling_resume(monkeypatch, tmp_path):
+    products = [Product.objects.create(image=f'missing{index}.jpg') for index in range(3)]
+    report = str(tmp_path / 'report.jsonl')
+    find_missing = dangling.find_missing
+    pages = []
+
+    def fail_on_third_page(*args):
+        pages.append(args)
+        if len(pages) == 3:
+            raise OSError('storage unavailable')
+        return find_missing(*args)
+
+    monkeypatch.setattr(dangling, 'find_missing', fail_on_third_page)
+    with pytest.raises(OSError):
+        dangling.check(report, chunk_size=1)
+    assert len(read_report(report)) == 2
+
+    monkeypatch.setattr(dangling, 'find_missing', find_missing)
+    state = dangling.check(report, chunk_size=1)
+    assert [row['pk'] for row in read_report(report)] == [product.pk for product in products]
+    assert state['missing'] == 3
+
+    state = dangling.check(report, chunk_size=1, restart=True)
+    assert len(read_report(report)) == 3
+    assert state['missing'] == 3
+#endregion
+
+
+#region dispatch and lazy mode
+def disconnect_handlers():
+    for model in cache.cleanup_models():
+        suffix = f'_django_cleanup_{cache.get_model_name(model)}'
+        for signal, prefix in zip(
+                (post_init, pre_save, post_save, post_delete),
+                ('post_init', 'pre_save', 'post_save', 'post_delete')):
+            signal.disconnect(None, sender=model, dispatch_uid=f'{prefix}{suffix}')
+
+
+@pytest.fixture
+def reconnect():
+    def prepare_and_connect():
+        disconnect_handlers()
+        cache.FIELDS.clear()
+        apps.prepare_and_connect(False)
+    try:
+        yield prepare_and_connect
+    finally:
+        handlers.disconnect_dispatchers()
+        cache.FIELDS.clear()
+        cache.prepare(False)
+        handlers.connect()
+
+
+@pytest.fixture
+def lazy_mode(settings, reconnect):
+    settings.CLEANUP_LAZY = True
+    reconnect()
+
+
+def test_single_dispatch(picture, settings, reconnect):
+    settings.CLEANUP_DISPATCH = 'single'
+    reconnect()
+    uids = [receiver[0][0] for receiver in post_init.receivers]
+    assert uids.count('post_init_django_cleanup') == 1
+    assert 'post_init_django_cleanup_test.product' not in uids
+    # a post_delete receiver for every model would stop the ORM fast delete of all models
+    assert not post_delete.has_listeners(RootProduct)
+    assert cleanup.startup_report()['dispatch'] == 'single'
+    product = Product.objects.create(image=picture['filename'])
+    product.image = get_random_pic_name()
+    with transaction.atomic():
+        product.save()
+    assert not os.path.exists(picture['path'])
+    RootProduct.objects.create().delete()
+    assert RootProduct not in cache.PLANS
+
+
+def test_dispatch_invalid(settings, reconnect):
+    settings.CLEANUP_DISPATCH = 'signal'
+    with pytest.raises(ImproperlyConfigured):
+        reconnect()
+
+
+def test_lazy(picture, lazy_mode):
+    assert not cache.PLANS
+    # post_delete is connected to the models with file fields before they are prepared
+    assert post_delete.has_listeners(Product)
+    assert not post_delete.has_listeners(ProductIgnore)
+    assert not post_delete.has_listeners(RootProduct)
+    product = Product.objects.create(image=picture['filename'])
+    assert cache.get_plan(Product).model_name == 'test.product'
+    assert list(cache.PLANS) == [Product]
+    product.image = get_random_pic_name()
+    with transaction.atomic():
+        product.save()
+    assert not os.path.exists(picture['path'])
+
+    RootProduct.objects.create()
+    assert cache.PLANS[RootProduct] is cache.EMPTY_PLAN
+    assert cleanup.startup_report()['lazy_models'] == 2
+    assert {cache.get_model_name(model) for model in cache.cleanup_models()} >= {
+        'test.product', 'test.productproxy', 'test.branchproduct'}
+    report = cleanup.startup_report()
+    assert report['mode'] == 'lazy'
+    assert report['lazy_models'] > 2
+
+
+def test_lazy_historical_model(picture, lazy_mode):
+    historical = ProjectState.from_apps(django_apps).apps.get_model('test', 'Product')
+    historical(image=picture['filename'])
+    assert cache.PLANS[historical] is cache.EMPTY_PLAN
+    assert cache.get_plan(Product).model_name == 'test.product'
+
+
+def test_lazy_queryset(picture, lazy_mode):
+    Product.objects.bulk_create([Product(image=picture['filename'])])
+    # as in a new process
+    cache.FIELDS.clear()
+    cache.prepare_lazy(False)
+    Product.objects.update(image=get_random_pic_name())
+    assert not os.path.exists(picture['path'])
+
+
+def test_lazy_cascade_unprepared(picture, lazy_mode):
+    root = RootProduct.objects.create()
+    BranchProduct.objects.create(root=root, image=picture['filename'])
+    # as in a new process
+    cache.FIELDS.clear()
+    cache.prepare_lazy(False)
+    root.delete()
+    assert not os.path.exists(picture['path'])
+
+
+def test_startup_report():
+    apps.prepare_and_connect(False)
+    report = cleanup.startup_report()
+    assert report['mode'] == 'eager'
+    assert report['prepare_seconds'] >= 0
+    assert report['connect_seconds'] >= 0
+#endregion
+
+
+#region fast delete
+@pytest.fixture
+def loaded():
+    instances = []
+    def receiver(sender, instance, **kwargs):
+        instances.append(instance)
+    post_init.connect(receiver, sender=FastBranchProduct, weak=False)
+    try:
+        yield instances
+    finally:
+        post_init.disconnect(receiver, sender=FastBranchProduct)
+
+
+def test_fast_delete_cascade(picture, loaded):
+    assert not post_delete.has_listeners(FastBranchProduct)
+    root = FastRootProduct.objects.create()
+    FastBranchProduct.objects.create(root=root, image=picture['filename'])
+    FastBranchProduct.objects.create(root=root)
+    loaded.clear()
+    with transaction.atomic():
+        root.delete()
+        assert os.path.exists(picture['path'])
+    assert not loaded
+    assert not FastBranchProduct.objects.exists()
+    assert not os.path.exists(picture['path'])
+
+
+def test_fast_delete_queryset(picture, loaded):
+    FastBranchProduct.objects.create(
+        root=FastRootProduct.objects.create(), image=picture['filename'])
+    loaded.clear()
+    with CaptureQueriesContext(connection) as queries:
+        FastBranchProduct.objects.all().delete()
+    assert not loaded
+    statements = [query['sql'].split()[0] for query in queries.captured_queries]
+    assert statements == ['BEGIN', 'SELECT', 'DELETE', 'COMMIT']
+    assert not os.path.exists(picture['path'])
+
+
+def test_fast_delete_instance(picture):
+    branch = FastBranchProduct.objects.create(
+        root=FastRootProduct.objects.create(), image=picture['filename'])
+    pk = branch.pk
+    with cleanup.dry_run() as plan:
+        with transaction.atomic():
+            branch.delete()
+    assert [(deletion.pk, deletion.reason) for deletion in plan.deletions] == [(pk, 'deleted')]
+    branch = FastBranchProduct.objects.create(
+        root=FastRootProduct.objects.create(), image=picture['filename'])
+    branch.delete()
+    assert not os.path.exists(picture['path'])
+
+
+@pytest.fixture
+def delete_receiver():
+    def receiver(**kwargs):
+        pass
+    pre_delete.connect(receiver, sender=FastBranchProduct)
+    try:
+        yield receiver
+    finally:
+        pre_delete.disconnect(receiver, sender=FastBranchProduct)
+        post_delete.disconnect(
+            None, sender=FastBranchProduct,
+            dispatch_uid='post_delete_django_cleanup_test.fastbranchproduct')
+        cache.FAST_DELETE_BLOCKED.clear()
+
+
+def test_fast_delete_receiver_connected_later(picture, delete_receiver):
+    root = FastRootProduct.objects.create()
+    FastBranchProduct.objects.create(root=root, image=picture['filename'])
+    root.delete()
+    assert not cache.is_fast_delete(FastBranchProduct)
+    assert post_delete.has_listeners(FastBranchProduct)
+    assert not os.path.exists(picture['path'])
+
+    branch = FastBranchProduct.objects.create(
+        root=FastRootProduct.objects.create(), image=picture['filename'])
+    pk = branch.pk
+    with cleanup.dry_run() as plan:
+        with transaction.atomic():
+            branch.delete()
+    assert [(deletion.pk, deletion.reason) for deletion in plan.deletions] == [(pk, 'deleted')]
+
+
+def test_fast_delete_lazy(picture, lazy_mode):
+    FastBranchProduct.objects.create(
+        root=FastRootProduct.objects.create(), image=picture['filename'])
+    assert post_delete.has_listeners(FastBranchProduct)
+    FastRootProduct.objects.all().delete()
+    assert not os.path.exists(picture['path'])
+
+
+def test_fast_delete_base_manager(monkeypatch):
+    monkeypatch.setattr(apps, 'CleanupQuerySetMixin', type('Mixin', (), {}))
+    with pytest.raises(ImproperlyConfigured, match='test.fastbranchproduct'):
+        apps.check_fast_delete()
+
+
+def test_fast_delete_blocked(monkeypatch):
+    apps.check_fast_delete()
+    def receiver(**kwargs):
+        pass
+    pre_delete.connect(receiver, sender=FastBranchProduct)
+    try:
+        with pytest.raises(ImproperlyConfigured, match='receivers'):
+            apps.check_fast_delete()
+    finally:
+        pre_delete.disconnect(receiver, sender=FastBranchProduct)
+
+    # the reverse relations of a model that cascades
+    candidates = apps.get_candidate_relations_to_delete
+    monkeypatch.setattr(
+        apps, 'get_candidate_relations_to_delete',
+        lambda opts: candidates(FastRootProduct._meta))
+    with pytest.raises(ImproperlyConfigured, match='fastbranchproduct.root does not use'):
+        apps.check_fast_delete()
+    monkeypatch.undo()
+
+    monkeypatch.setattr(FastBranchProduct._meta, 'parents', {FastRootProduct: None})
+    with pytest.raises(ImproperlyConfigured, match='parent models'):
+        apps.check_fast_delete()
+#endregion
+
+
 #region select config
 @pytest.mark.cleanup_selected_config
 def test__select_config__replace_file_with_file(picture):
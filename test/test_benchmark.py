@@ -0,0 +1,20 @@
+from django.apps import apps
+
+from . import benchmark
+from .models.benchmark import FILE_FIELD_COUNTS
+
+
+def test_benchmark_runs():
+    results = benchmark.run(rows=5, repeat=1)
+    assert {(result['benchmark'], result['file_fields']) for result in results} == {
+        (name, count) for name in benchmark.BENCHMARKS for count in FILE_FIELD_COUNTS}
+    assert benchmark.compare(results, results, 1.25) == []
+    baseline = [dict(result, overhead=1) for result in results]
+    regressed = [dict(result, overhead=2) for result in results]
+    assert len(benchmark.compare(regressed, baseline, 1.25)) == len(results)
+
+
+def test_benchmark_dispatch_runs():
+    results = benchmark.run_dispatch(models=3, rows=5, repeat=1)
+    assert [result['dispatch'] for result in results] == ['model', 'single']
+    assert not [model for model in apps.get_models() if model.__name__.startswith('Dispatch')]